@@ -0,0 +1,755 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+import grpc
+from concurrent import futures
+
+from google.protobuf import empty_pb2
+from google.protobuf import wrappers_pb2
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from protos.api import evaluator_pb2
+from protos.api import evaluator_pb2_grpc
+from protos.api import frontend_pb2
+from protos.api import frontend_pb2_grpc
+from protos.api import matchfunction_pb2
+from protos.api import matchfunction_pb2_grpc
+from protos.api import messages_pb2
+from protos.api import query_pb2
+from protos.api import query_pb2_grpc
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REGIONS = ['asia', 'eu', 'na', 'sa']
+
+
+def make_tickets(count, seed=0):
+    """game_frontend.create_ticket と同じ分布の合成チケット"""
+    rng = random.Random(seed)
+    now_ns = time.time_ns()
+    tickets = []
+    for i in range(count):
+        ticket = messages_pb2.Ticket(
+            id=f'bench-{i}',
+            search_fields=messages_pb2.SearchFields(
+                tags=["mode.session"],
+                double_args={
+                    "skill": 2 * rng.random(),
+                    "latency": 50.0 * rng.expovariate(1.0)
+                },
+                string_args={
+                    "region": rng.choice(REGIONS)
+                }
+            )
+        )
+        ticket.create_time.FromNanoseconds(now_ns - rng.randrange(120 * 10**9))
+        tickets.append(ticket)
+    return tickets
+
+
+def make_matches(count, tickets_per_match=2, seed=0):
+    tickets = make_tickets(count * tickets_per_match, seed)
+    return [
+        messages_pb2.Match(
+            match_id=f'bench-match-{i}',
+            match_profile='bench-profile',
+            match_function='matchfunction',
+            tickets=tickets[i * tickets_per_match:(i + 1) * tickets_per_match]
+        )
+        for i in range(count)
+    ]
+
+
+class FakeOpenMatch(query_pb2_grpc.QueryServiceServicer, frontend_pb2_grpc.FrontendServiceServicer):
+    """固定チケットを返す Query / Frontend サービス（ベンチマーク用）"""
+
+    def __init__(self, tickets):
+        self.tickets = tickets
+        self.by_id = {ticket.id: ticket for ticket in tickets}
+
+    def QueryTickets(self, request, context):
+        for i in range(0, len(self.tickets), 1000):
+            yield query_pb2.QueryTicketsResponse(tickets=self.tickets[i:i + 1000])
+
+    def QueryTicketIds(self, request, context):
+        ids = list(self.by_id)
+        for i in range(0, len(ids), 10000):
+            yield query_pb2.QueryTicketIdsResponse(ids=ids[i:i + 10000])
+
+    def QueryBackfills(self, request, context):
+        return iter(())
+
+    def GetTicket(self, request, context):
+        ticket = self.by_id.get(request.ticket_id)
+        if ticket is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'ticket not found')
+        return ticket
+
+
+def _serve_fake_open_match(port, ticket_count):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+    fake = FakeOpenMatch(make_tickets(ticket_count))
+    query_pb2_grpc.add_QueryServiceServicer_to_server(fake, server)
+    frontend_pb2_grpc.add_FrontendServiceServicer_to_server(fake, server)
+    server.add_insecure_port(f'127.0.0.1:{port}')
+    server.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop(0))
+    server.wait_for_termination()
+
+
+class FakeFrontend(frontend_pb2_grpc.FrontendServiceServicer):
+    """assign_after 秒後にアサインを返す grpc.aio の Frontend（HTTP フロントエンドの待機者試験用）"""
+
+    def __init__(self, assign_after):
+        self.assign_after = assign_after
+        self.created = 0
+        self.deleted = 0
+
+    async def CreateTicket(self, request, context):
+        self.created += 1
+        ticket = messages_pb2.Ticket()
+        ticket.CopyFrom(request.ticket)
+        ticket.id = f'bench-ticket-{self.created}'
+        return ticket
+
+    async def WatchAssignments(self, request, context):
+        await asyncio.sleep(self.assign_after)
+        yield frontend_pb2.WatchAssignmentsResponse(
+            assignment=messages_pb2.Assignment(connection='10.0.0.1:7777')
+        )
+
+    async def DeleteTicket(self, request, context):
+        self.deleted += 1
+        return empty_pb2.Empty()
+
+
+def _serve_fake_frontend(port, assign_after):
+    async def serve():
+        server = grpc.aio.server()
+        frontend_pb2_grpc.add_FrontendServiceServicer_to_server(FakeFrontend(assign_after), server)
+        server.add_insecure_port(f'127.0.0.1:{port}')
+        await server.start()
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        await stop.wait()
+        await server.stop(0)
+
+    asyncio.run(serve())
+
+
+def _wait_ready(address, timeout=15):
+    channel = grpc.insecure_channel(address)
+    try:
+        grpc.channel_ready_future(channel).result(timeout=timeout)
+    finally:
+        channel.close()
+
+
+def _serving_client(target, address, duration, matches_per_stream, results):
+    channel = grpc.insecure_channel(address)
+    if target == 'evaluator':
+        stub = evaluator_pb2_grpc.EvaluatorStub(channel)
+        requests = [evaluator_pb2.EvaluateRequest(match=m) for m in make_matches(matches_per_stream)]
+
+        def call():
+            for _ in stub.Evaluate(iter(requests), timeout=30):
+                pass
+    else:
+        stub = matchfunction_pb2_grpc.MatchFunctionStub(channel)
+        profile = messages_pb2.MatchProfile(name='bench-profile', pools=[messages_pb2.Pool(name='everyone')])
+        request = matchfunction_pb2.RunRequest(profile=profile)
+
+        def call():
+            for _ in stub.Run(request, timeout=30):
+                pass
+
+    completed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        call()
+        completed += 1
+    channel.close()
+    results.put(completed)
+
+
+def bench_serving(args):
+    """--workers の各値でサーバーを起動し、並行クライアントの RPS を測る"""
+    script = os.path.join(HERE, f'{args.target}.py')
+    address = f'127.0.0.1:{args.port}'
+    env = dict(os.environ)
+    fake = None
+
+    if args.target == 'matchfunction':
+        fake_port = args.port + 1
+        fake = multiprocessing.Process(target=_serve_fake_open_match, args=(fake_port, args.tickets))
+        fake.start()
+        _wait_ready(f'127.0.0.1:{fake_port}')
+        env.update(
+            OPEN_MATCH_QUERY_SERVICE='127.0.0.1',
+            OPEN_MATCH_QUERY_SERVICE_PORT=str(fake_port),
+            OPEN_MATCH_FRONTEND_SERVICE=f'127.0.0.1:{fake_port}',
+        )
+
+    rows = []
+    try:
+        for workers in args.workers:
+            server = subprocess.Popen(
+                [sys.executable, script, '--port', str(args.port),
+                 '--workers', str(workers), '--threads', str(args.threads)],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                _wait_ready(address)
+                time.sleep(1)
+                results = multiprocessing.Queue()
+                clients = [
+                    multiprocessing.Process(
+                        target=_serving_client,
+                        args=(args.target, address, args.duration, args.matches, results)
+                    )
+                    for _ in range(args.clients)
+                ]
+                for client in clients:
+                    client.start()
+                completed = sum(results.get() for _ in clients)
+                for client in clients:
+                    client.join()
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=30)
+
+            rps = completed / args.duration
+            rows.append((workers, completed, rps))
+            logger.info(f"{args.target} workers={workers}: {completed} RPCs in {args.duration}s ({rps:.1f} RPS)")
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.join()
+
+    print(f"\n{args.target}: {args.clients} clients, {args.threads} threads/worker, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'RPCs':>10} {'RPS':>10} {'speedup':>8}")
+    for workers, completed, rps in rows:
+        print(f"{workers:>8} {completed:>10} {rps:>10.1f} {rps / rows[0][2] if rows[0][2] else 0:>7.2f}x")
+
+
+def make_overlapping_matches(refs, tickets_per_match=2, overlap=2.0, seed=0):
+    """チケット参照数 refs の提案。各チケットは平均 overlap 件の提案に含まれる"""
+    rng = random.Random(seed)
+    universe = max(tickets_per_match, int(refs / overlap))
+    matches = []
+    for i in range(refs // tickets_per_match):
+        match = messages_pb2.Match(match_id=f'bench-match-{i}', match_profile='bench-profile')
+        for ticket in rng.sample(range(universe), tickets_per_match):
+            match.tickets.add(id=f'bench-{ticket}')
+        match.extensions['quality'].Pack(wrappers_pb2.DoubleValue(value=rng.random()))
+        matches.append(match)
+    return matches
+
+
+def _dense_select(evaluator, matches):
+    batch = evaluator.ProposalBatch()
+    for match in matches:
+        batch.add(match)
+    return batch, batch.select()[0]
+
+
+def _peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_conflicts(args):
+    """Evaluator の重なり解消（インデックス版 select_disjoint と numpy 版 ProposalBatch）を比較する
+
+    numpy 版の時間は受信ループ側の add も含めた合計。
+    """
+    import evaluator
+
+    print(f"\n{args.size} tickets/proposal, each ticket in ~{args.overlap} proposals")
+    print(f"{'refs':>9} {'proposals':>10} {'approved':>9} {'index ms':>9} {'numpy ms':>9} {'speedup':>8} "
+          f"{'rounds':>7} {'index MiB':>10} {'numpy MiB':>10}")
+    for refs in args.refs:
+        matches = make_overlapping_matches(refs, args.size, args.overlap)
+
+        start = time.perf_counter()
+        expected = evaluator.select_disjoint(matches)
+        index_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch, approved = _dense_select(evaluator, matches)
+        dense_seconds = time.perf_counter() - start
+
+        if [m.match_id for m in approved] != [m.match_id for m in expected]:
+            raise AssertionError(f'engines disagree at {refs} refs')
+
+        index_peak = _peak_memory(evaluator.select_disjoint, matches)
+        dense_peak = _peak_memory(_dense_select, evaluator, matches)
+        print(f"{refs:>9} {len(matches):>10} {len(approved):>9} {index_seconds * 1000:>9.1f} "
+              f"{dense_seconds * 1000:>9.1f} {index_seconds / dense_seconds:>7.2f}x {batch.rounds:>7} "
+              f"{index_peak / 2**20:>10.1f} {dense_peak / 2**20:>10.1f}")
+
+
+def _oracle_in_pool(ticket, pool):
+    """Open Match のプールフィルタの意味を protobuf のフィールドから直接たどる参照実装（PoolFilter とは独立）"""
+    fields = ticket.search_fields
+    if ticket.HasField('create_time'):
+        created = ticket.create_time.seconds * 10**9 + ticket.create_time.nanos
+        if pool.HasField('created_after'):
+            if not created > pool.created_after.seconds * 10**9 + pool.created_after.nanos:
+                return False
+        if pool.HasField('created_before'):
+            if not created < pool.created_before.seconds * 10**9 + pool.created_before.nanos:
+                return False
+    for f in pool.double_range_filters:
+        if f.double_arg not in fields.double_args:
+            return False
+        value = fields.double_args[f.double_arg]
+        exclude_min = f.exclude in (messages_pb2.DoubleRangeFilter.MIN, messages_pb2.DoubleRangeFilter.BOTH)
+        exclude_max = f.exclude in (messages_pb2.DoubleRangeFilter.MAX, messages_pb2.DoubleRangeFilter.BOTH)
+        if not (value > f.min if exclude_min else value >= f.min):
+            return False
+        if not (value < f.max if exclude_max else value <= f.max):
+            return False
+    for f in pool.string_equals_filters:
+        if f.string_arg not in fields.string_args or fields.string_args[f.string_arg] != f.value:
+            return False
+    return all(f.tag in fields.tags for f in pool.tag_present_filters)
+
+
+POOL_CHECK_VALUES = [0.0, 0.5, 1.0, 2.0, -1.0, float('nan'), float('inf'), float('-inf')]
+POOL_CHECK_BASE_NS = 1_700_000_000_000_000_000
+
+
+def make_pool_check_tickets(count, rng):
+    """欠損・NaN・無限大・同時刻を多く含むチケット"""
+    tickets = []
+    for i in range(count):
+        ticket = messages_pb2.Ticket(id=f'check-{i}')
+        if rng.random() < 0.9:
+            ticket.create_time.FromNanoseconds(POOL_CHECK_BASE_NS + rng.choice([0, 1, 2, 3, 10]))
+        for name in ('skill', 'latency'):
+            if rng.random() < 0.8:
+                ticket.search_fields.double_args[name] = rng.choice(POOL_CHECK_VALUES)
+        for name in ('region', 'mode'):
+            if rng.random() < 0.8:
+                ticket.search_fields.string_args[name] = rng.choice(['a', 'b', ''])
+        ticket.search_fields.tags.extend(rng.sample(['x', 'y', 'z'], rng.randint(0, 3)))
+        tickets.append(ticket)
+    return tickets
+
+
+def make_check_pool(name, rng):
+    pool = messages_pb2.Pool(name=name)
+    bounds = [0.0, 0.5, 1.0, 2.0, -1.0]
+    for _ in range(rng.randint(0, 2)):
+        pool.double_range_filters.add(
+            double_arg=rng.choice(['skill', 'latency', 'missing']),
+            min=rng.choice(bounds + [float('-inf')]), max=rng.choice(bounds + [float('inf')]),
+            exclude=rng.choice(list(messages_pb2.DoubleRangeFilter.Exclude.values())),
+        )
+    for _ in range(rng.randint(0, 2)):
+        pool.string_equals_filters.add(string_arg=rng.choice(['region', 'mode', 'missing']),
+                                       value=rng.choice(['a', 'b', '', 'c']))
+    for _ in range(rng.randint(0, 2)):
+        pool.tag_present_filters.add(tag=rng.choice(['x', 'y', 'z', 'w']))
+    if rng.random() < 0.3:
+        pool.created_after.FromNanoseconds(POOL_CHECK_BASE_NS + rng.choice([0, 1, 2, 3]))
+    if rng.random() < 0.3:
+        pool.created_before.FromNanoseconds(POOL_CHECK_BASE_NS + rng.choice([1, 2, 3, 10]))
+    return pool
+
+
+def pool_check_edge_cases():
+    """境界・欠損の固定ケース: (チケット一覧, プール一覧)"""
+    tickets = [messages_pb2.Ticket(id='edge-empty')]
+    for i, value in enumerate(POOL_CHECK_VALUES):
+        tickets.append(messages_pb2.Ticket(id=f'edge-value-{i}', search_fields=messages_pb2.SearchFields(
+            double_args={'skill': value}, string_args={'region': 'a'}, tags=['x'])))
+    tickets.append(messages_pb2.Ticket(id='edge-blank-region', search_fields=messages_pb2.SearchFields(
+        double_args={'skill': 1.0}, string_args={'region': ''})))
+    for offset in (-1, 0, 1):
+        ticket = messages_pb2.Ticket(id=f'edge-created{offset:+d}', search_fields=messages_pb2.SearchFields(
+            double_args={'skill': 1.0}, string_args={'region': 'a'}, tags=['x']))
+        ticket.create_time.FromNanoseconds(POOL_CHECK_BASE_NS + offset)
+        tickets.append(ticket)
+
+    pools = [messages_pb2.Pool(name='no-filters')]
+    for exclude in messages_pb2.DoubleRangeFilter.Exclude.values():
+        for low, high in ((0.5, 1.0), (1.0, 1.0), (float('-inf'), float('inf')), (0.0, float('inf'))):
+            pools.append(messages_pb2.Pool(name=f'range-{exclude}-{low}-{high}', double_range_filters=[
+                messages_pb2.DoubleRangeFilter(double_arg='skill', min=low, max=high, exclude=exclude)]))
+    pools.append(messages_pb2.Pool(name='blank-region', string_equals_filters=[
+        messages_pb2.StringEqualsFilter(string_arg='region', value='')]))
+    pools.append(messages_pb2.Pool(name='tag-x', tag_present_filters=[messages_pb2.TagPresentFilter(tag='x')]))
+    for name in ('created_after', 'created_before'):
+        pool = messages_pb2.Pool(name=f'{name}-equal')
+        getattr(pool, name).FromNanoseconds(POOL_CHECK_BASE_NS)
+        pools.append(pool)
+    both = messages_pb2.Pool(name='created-window')
+    both.created_after.FromNanoseconds(POOL_CHECK_BASE_NS - 1)
+    both.created_before.FromNanoseconds(POOL_CHECK_BASE_NS + 1)
+    pools.append(both)
+    return tickets, pools
+
+
+def bench_pools(args):
+    """PoolFilter.evaluate（列評価）と PoolFilter.matches を参照実装と突き合わせ、所要時間を比べる
+
+    一致しない場合は AssertionError で終了する（ローカルのプール振り分けの適合性チェック）。
+    """
+    import matchfunction
+
+    rng = random.Random(args.seed)
+    cases = [pool_check_edge_cases()]
+    tickets = make_pool_check_tickets(args.tickets, rng)
+    cases.append((tickets, [make_check_pool(f'random-{i}', rng) for i in range(args.pools)]))
+
+    checked = 0
+    evaluate_seconds = matches_seconds = 0.0
+    for tickets, pools in cases:
+        batch = matchfunction.TicketBatch(tickets)
+        for pool in pools:
+            expected = [row for row, ticket in enumerate(tickets) if _oracle_in_pool(ticket, pool)]
+            pool_filter = matchfunction.PoolFilter(pool)
+
+            start = time.perf_counter()
+            evaluated = list(matchfunction.bitset_rows(pool_filter.evaluate(batch)))
+            evaluate_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            matched = [row for row, ticket in enumerate(tickets) if pool_filter.matches(ticket)]
+            matches_seconds += time.perf_counter() - start
+
+            if evaluated != expected or matched != expected:
+                raise AssertionError(
+                    f"pool '{pool.name}' disagrees with the reference: expected {expected}, "
+                    f"evaluate {evaluated}, matches {matched}\n{pool}"
+                )
+            checked += 1
+
+    # 共通フィルタのプールは各プールの上位集合であること
+    for _ in range(args.pools // 10):
+        pools = [make_check_pool(f'superset-{i}', rng) for i in range(rng.randint(2, 4))]
+        superset = matchfunction.superset_pool(pools)
+        for ticket in tickets:
+            if any(_oracle_in_pool(ticket, pool) for pool in pools) and not _oracle_in_pool(ticket, superset):
+                raise AssertionError(f"superset pool misses ticket {ticket.id}\n{superset}")
+
+    print(f"\n{checked} pools agree with the reference "
+          f"({len(cases[0][1])} edge-case pools, {args.pools} random pools over {args.tickets} tickets)")
+    print(f"{'evaluate':>10} {evaluate_seconds * 1000:>9.1f} ms")
+    print(f"{'matches':>10} {matches_seconds * 1000:>9.1f} ms")
+
+
+def bench_strategies(args):
+    """登録済みの戦略を同じチケット集合で比較する"""
+    import matchfunction
+
+    names = args.strategies or sorted(matchfunction.STRATEGIES)
+    profile = messages_pb2.MatchProfile(name='bench-profile', pools=[messages_pb2.Pool(name='everyone')])
+    batch = matchfunction.TicketBatch.from_pools({'everyone': make_tickets(args.tickets)})
+
+    print(f"\n{args.tickets} tickets, best of {args.repeat}")
+    print(f"{'strategy':>16} {'matches':>8} {'tickets':>8} {'best ms':>9} {'mean ms':>9}")
+    for name in names:
+        strategy = matchfunction.STRATEGIES[name]({})
+        result = matchfunction.benchmark_strategy(strategy, profile, batch, args.repeat)
+        print(f"{name:>16} {result['matches']:>8} {result['matched_tickets']:>8} "
+              f"{result['best_seconds'] * 1000:>9.2f} {result['mean_seconds'] * 1000:>9.2f}")
+
+
+def _process_status(pid):
+    """/proc/<pid>/status から (RSS バイト, スレッド数)"""
+    rss = threads = 0
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+async def _http_request(port, method, path, token, timeout, body=b''):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(
+            f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer {token}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+        return int(response.split(b' ', 2)[1])
+    finally:
+        writer.close()
+
+
+def _wait_http(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            asyncio.run(_http_request(port, 'GET', '/health', '', 5))
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def bench_waiters(args):
+    """game_frontend の /play に同時待機者を並べ、完了数と待機者あたりのメモリを測る"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    fake_port = args.port + 1
+    fake = multiprocessing.Process(target=_serve_fake_frontend, args=(fake_port, args.hold))
+    fake.start()
+    _wait_ready(f'127.0.0.1:{fake_port}')
+
+    token = 'bench-token'
+    env = dict(os.environ, PORT=str(args.port), BEARER_TOKEN=token,
+               OPEN_MATCH_FRONTEND_SERVICE=f'127.0.0.1:{fake_port}',
+               ASSIGNMENT_TIMEOUT=str(int(args.hold * 3 + 30)))
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'game_frontend.py')],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    rows = []
+    try:
+        _wait_http(args.port)
+        for waiters in args.waiters:
+            base_rss, base_threads = _process_status(server.pid)
+
+            async def run():
+                start = time.monotonic()
+                tasks = [
+                    asyncio.ensure_future(
+                        _http_request(args.port, 'GET', f'/play/{REGIONS[i % len(REGIONS)]}', token, args.hold * 3 + 60)
+                    )
+                    for i in range(waiters)
+                ]
+                peak_rss, peak_threads = base_rss, base_threads
+                while not all(task.done() for task in tasks):
+                    rss, threads = _process_status(server.pid)
+                    peak_rss, peak_threads = max(peak_rss, rss), max(peak_threads, threads)
+                    await asyncio.sleep(0.2)
+                statuses = [task.result() if not task.exception() else None for task in tasks]
+                return statuses, time.monotonic() - start, peak_rss, peak_threads
+
+            statuses, elapsed, peak_rss, peak_threads = asyncio.run(run())
+            ok = statuses.count(200)
+            per_waiter = (peak_rss - base_rss) / waiters
+            rows.append((waiters, ok, elapsed, peak_rss, per_waiter, peak_threads))
+            logger.info(f"{waiters} waiters: {ok} matched in {elapsed:.1f}s, "
+                        f"RSS {base_rss / 2**20:.1f} -> {peak_rss / 2**20:.1f} MiB, threads {peak_threads}")
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        fake.terminate()
+        fake.join()
+
+    print(f"\n/play waiters held {args.hold}s each by the fake Open Match frontend")
+    print(f"{'waiters':>8} {'matched':>8} {'seconds':>8} {'peak MiB':>9} {'KiB/waiter':>11} {'threads':>8}")
+    for waiters, ok, elapsed, peak_rss, per_waiter, threads in rows:
+        print(f"{waiters:>8} {ok:>8} {elapsed:>8.1f} {peak_rss / 2**20:>9.1f} {per_waiter / 1024:>11.1f} {threads:>8}")
+
+
+def bench_jwt(args):
+    """JWT 発行の tokens/sec（毎回 PEM を作って jwt.encode する旧経路と JWTIssuer の比較）"""
+    from datetime import datetime, timedelta
+
+    import jwt
+    from cryptography.hazmat.primitives import serialization
+
+    import game_frontend
+
+    game_frontend.generate_rsa_keypair()
+    issuer = game_frontend.JWT_ISSUER
+    server_info = {'ip': '10.0.0.1', 'port': '7777', 'connection': '10.0.0.1:7777'}
+    claims = [
+        (f'bench-ticket-{i}', server_info, {'skill': 1.0, 'latency': 20.0, 'region': 'asia'})
+        for i in range(args.tokens)
+    ]
+
+    def pem_encode():
+        for ticket_id, server, player in claims:
+            now = datetime.utcnow()
+            payload = {'ticket_id': ticket_id, 'server': server, 'player': player,
+                       'iat': now, 'exp': now + timedelta(minutes=game_frontend.JWT_EXPIRATION_MINUTES)}
+            private_pem = game_frontend.PRIVATE_KEY.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            jwt.encode(payload, private_pem, algorithm='RS256')
+
+    def issue():
+        for claim in claims:
+            issuer.issue(*claim)
+
+    def issue_match():
+        for i in range(0, len(claims), args.match_size):
+            issuer.issue_many(claims[i:i + args.match_size])
+
+    # 旧経路と同じトークンになること、公開鍵で検証できることを確認する
+    now = datetime.utcnow().replace(microsecond=0)
+    ticket_id, server, player = claims[0]
+    expected = jwt.encode({'ticket_id': ticket_id, 'server': server, 'player': player, 'iat': now,
+                           'exp': now + timedelta(minutes=game_frontend.JWT_EXPIRATION_MINUTES)},
+                          game_frontend.PRIVATE_KEY, algorithm='RS256')
+    token = issuer.issue(ticket_id, server, player, now)
+    if token != expected:
+        raise AssertionError('JWTIssuer output differs from jwt.encode')
+    jwt.decode(token, game_frontend.PUBLIC_KEY_PEM, algorithms=['RS256'])
+
+    print(f"\n{args.tokens} RS256 tokens (2048-bit key)")
+    print(f"{'path':>24} {'tokens/s':>10} {'speedup':>8}")
+    baseline = None
+    for name, func in (('PEM + jwt.encode', pem_encode), ('JWTIssuer.issue', issue),
+                       (f'issue_many ({args.match_size}/match)', issue_match)):
+        start = time.perf_counter()
+        func()
+        rate = args.tokens / (time.perf_counter() - start)
+        baseline = baseline or rate
+        print(f"{name:>24} {rate:>10.0f} {rate / baseline:>7.2f}x")
+
+
+def _spread(tickets, name):
+    values = [t.search_fields.double_args[name] for t in tickets if name in t.search_fields.double_args]
+    return max(values) - min(values) if values else 0.0
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_replay(args):
+    """キャプチャした Run を戦略に再投入し、時間・メモリ・マッチ品質を報告する"""
+    import matchfunction
+
+    registry = matchfunction.StrategyRegistry()
+    override = None
+    if args.strategy:
+        override = matchfunction.STRATEGIES[args.strategy](json.loads(args.config) if args.config else {})
+
+    skill_spreads, latency_spreads, waits, qualities = [], [], [], []
+    histogram = [0] * matchfunction.QUALITY_BUCKETS
+    runs = tickets = matches = matched = 0
+    total_seconds = peak_bytes = 0
+    for captured_at_ns, profile, batch in matchfunction.read_capture(args.capture):
+        strategy = override or registry.get(profile)
+        tracemalloc.start()
+        start = time.perf_counter()
+        proposals = list(strategy.match(profile, batch))
+        total_seconds += time.perf_counter() - start
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        runs += 1
+        tickets += len(batch)
+        matches += len(proposals)
+        scorer = matchfunction.QualityScorer(batch, histogram, now_ns=captured_at_ns)
+        qualities.extend(scorer.attach_all(proposals).tolist())
+        for match in proposals:
+            matched += len(match.tickets)
+            skill_spreads.append(_spread(match.tickets, 'skill'))
+            latency_spreads.append(_spread(match.tickets, 'latency'))
+            waits.extend(
+                (captured_at_ns - t.create_time.ToNanoseconds()) / 1e9
+                for t in match.tickets if t.HasField('create_time')
+            )
+        logger.info(f"run {runs} ({profile.name}, {strategy.name}): "
+                    f"{len(batch)} tickets -> {len(proposals)} matches")
+
+    print(f"\n{args.capture}: {runs} runs, {tickets} tickets")
+    print(f"{'matches':>20} {matches}")
+    print(f"{'matched tickets':>20} {matched} ({matched / tickets if tickets else 0:.1%})")
+    print(f"{'strategy time':>20} {total_seconds * 1000:.2f} ms ({total_seconds * 1000 / runs if runs else 0:.2f} ms/run)")
+    print(f"{'peak memory':>20} {peak_bytes / 2**20:.2f} MiB")
+    for label, values in (('quality', qualities), ('skill spread', skill_spreads), ('latency spread', latency_spreads),
+                          ('wait seconds', waits)):
+        mean = sum(values) / len(values) if values else 0.0
+        print(f"{label:>20} mean {mean:.3f}  p95 {_percentile(values, 0.95):.3f}")
+    print(f"{'quality histogram':>20} {matchfunction.format_quality_histogram(histogram)}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the matchmaking components')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serving = subparsers.add_parser('serving', help='RPS scaling of multi-worker gRPC serving')
+    serving.add_argument('--target', choices=['evaluator', 'matchfunction'], default='evaluator')
+    serving.add_argument('--workers', type=lambda v: [int(w) for w in v.split(',')], default=[1, 2, 4],
+                         help='Comma-separated worker counts to compare')
+    serving.add_argument('--threads', type=int, default=10, help='Handler threads per worker')
+    serving.add_argument('--clients', type=int, default=8, help='Concurrent client processes')
+    serving.add_argument('--duration', type=float, default=10, help='Seconds per measurement')
+    serving.add_argument('--matches', type=int, default=50, help='Proposals per Evaluate stream')
+    serving.add_argument('--tickets', type=int, default=2000, help='Tickets served to the match function')
+    serving.add_argument('--port', type=int, default=50600)
+    serving.set_defaults(func=bench_serving)
+
+    strategies = subparsers.add_parser('strategies', help='Compare match strategies on the same ticket set')
+    strategies.add_argument('--strategies', type=lambda v: v.split(','), default=None,
+                            help='Comma-separated strategy names (default: all registered)')
+    strategies.add_argument('--tickets', type=int, default=10000)
+    strategies.add_argument('--repeat', type=int, default=5)
+    strategies.set_defaults(func=bench_strategies)
+
+    pools = subparsers.add_parser('pools', help='Check local pool filtering against a reference implementation')
+    pools.add_argument('--pools', type=int, default=3000, help='Random pools to check')
+    pools.add_argument('--tickets', type=int, default=400, help='Tickets each random pool is evaluated over')
+    pools.add_argument('--seed', type=int, default=1)
+    pools.set_defaults(func=bench_pools)
+
+    conflicts = subparsers.add_parser('conflicts', help='Evaluator overlap resolution at large batch sizes')
+    conflicts.add_argument('--refs', type=lambda v: [int(r) for r in v.split(',')],
+                           default=[10000, 100000, 1000000], help='Comma-separated ticket reference counts')
+    conflicts.add_argument('--size', type=int, default=2, help='Tickets per proposal')
+    conflicts.add_argument('--overlap', type=float, default=2.0, help='Mean proposals per ticket')
+    conflicts.set_defaults(func=bench_conflicts)
+
+    waiters = subparsers.add_parser('waiters', help='Concurrent /play waiters on the HTTP game frontend')
+    waiters.add_argument('--waiters', type=lambda v: [int(w) for w in v.split(',')], default=[100, 1000, 3000],
+                         help='Comma-separated concurrent waiter counts')
+    waiters.add_argument('--hold', type=float, default=10, help='Seconds before the fake frontend assigns')
+    waiters.add_argument('--port', type=int, default=50610)
+    waiters.set_defaults(func=bench_waiters)
+
+    tokens = subparsers.add_parser('jwt', help='JWT issuance throughput of the game frontend')
+    tokens.add_argument('--tokens', type=int, default=500)
+    tokens.add_argument('--match-size', type=int, default=2, help='Tickets per match for issue_many')
+    tokens.set_defaults(func=bench_jwt)
+
+    replay = subparsers.add_parser('replay', help='Replay captured match function runs (MATCH_CAPTURE_PATH)')
+    replay.add_argument('capture', help='Capture file written by the match function')
+    replay.add_argument('--strategy', default=None,
+                        help='Strategy to replay with (default: the one each profile resolves to)')
+    replay.add_argument('--config', default=None, help='Strategy config as JSON')
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
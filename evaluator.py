@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
+import asyncio
+import collections
 import logging
+import multiprocessing
+import signal
+import threading
+import time
 import grpc
+import numpy as np
 from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import sys
 import os
 
+from google.protobuf import wrappers_pb2
+
 sys.path.insert(0, os.path.dirname(__file__))
 
 from protos.api import evaluator_pb2
@@ -18,26 +28,484 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+# 提案のスコアは Match.extensions の先頭から見つかったキー（DoubleValue）を使う
+# どれも無い提案は EVALUATOR_DEFAULT_SCORE とし、同点は到着順
+SCORE_EXTENSIONS = [
+    key.strip() for key in os.getenv('EVALUATOR_SCORE_EXTENSIONS', 'quality,score').split(',') if key.strip()
+]
+EVALUATOR_DEFAULT_SCORE = float(os.getenv('EVALUATOR_DEFAULT_SCORE', '0.5'))
+
+# 優先度 = プロファイル重み * スコア + EVALUATOR_WAIT_BONUS * 最古チケットの待ち秒（EVALUATOR_WAIT_CAP で頭打ち）
+# EVALUATOR_PROFILE_WEIGHTS: profile=weight,...（例: ranked=2.0,casual=0.5）。未指定のプロファイルは 1.0
+EVALUATOR_PROFILE_WEIGHTS = os.getenv('EVALUATOR_PROFILE_WEIGHTS', '')
+EVALUATOR_DEFAULT_WEIGHT = float(os.getenv('EVALUATOR_DEFAULT_WEIGHT', '1.0'))
+EVALUATOR_WAIT_BONUS = float(os.getenv('EVALUATOR_WAIT_BONUS', '0.0'))
+EVALUATOR_WAIT_CAP = float(os.getenv('EVALUATOR_WAIT_CAP', '300'))
+
+# ProposalBatch.select の配列演算ラウンドの上限。残った提案は優先度順に1件ずつ処理する
+SELECT_MAX_ROUNDS = 32
+
+# Prometheus テキスト形式の /metrics（0 で無効）。プリフォーク時はワーカー i が METRICS_PORT + i で公開する
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+
+_DOUBLE_VALUE_NAME = wrappers_pb2.DoubleValue.DESCRIPTOR.full_name
+
+
+def proposal_score(match):
+    extensions = match.extensions
+    for key in SCORE_EXTENSIONS:
+        if key in extensions:
+            # Any.Unpack と同じ型判定（type_url の最後の要素）を、中間メッセージを作らずに行う
+            value = extensions[key]
+            if value.type_url.rpartition('/')[2] == _DOUBLE_VALUE_NAME:
+                return wrappers_pb2.DoubleValue.FromString(value.value).value
+    return EVALUATOR_DEFAULT_SCORE
+
+
+def parse_profile_weights(spec):
+    weights = {}
+    for item in spec.split(','):
+        profile_name, _, weight = item.strip().partition('=')
+        if profile_name and weight:
+            weights[profile_name] = float(weight)
+    return weights
+
+
+class PriorityPolicy:
+    """プロファイル間で衝突したときの優先度
+
+    重みは起動時に辞書へ展開済みなので、提案ごとの計算は辞書参照1回と
+    チケットの create_time の走査だけで済む。
+    """
+
+    def __init__(self, profile_weights=EVALUATOR_PROFILE_WEIGHTS, default_weight=EVALUATOR_DEFAULT_WEIGHT,
+                 wait_bonus=EVALUATOR_WAIT_BONUS, wait_cap=EVALUATOR_WAIT_CAP):
+        self.weights = parse_profile_weights(profile_weights)
+        self.default_weight = default_weight
+        self.wait_bonus = wait_bonus
+        self.wait_cap = wait_cap
+
+    def priority(self, match, now_ns):
+        priority = self.weights.get(match.match_profile, self.default_weight) * proposal_score(match)
+        if self.wait_bonus:
+            priority += self._wait_priority(match, now_ns)
+        return priority
+
+    def priorities(self, matches, now_ns):
+        """priority と同じ値を全提案分まとめて numpy 配列で返す"""
+        weights = self.weights
+        default_weight = self.default_weight
+        priorities = np.fromiter(
+            (weights.get(match.match_profile, default_weight) for match in matches), dtype=np.float64,
+            count=len(matches)
+        )
+        priorities *= np.fromiter(map(proposal_score, matches), dtype=np.float64, count=len(matches))
+        if self.wait_bonus:
+            priorities += np.fromiter(
+                (self._wait_priority(match, now_ns) for match in matches), dtype=np.float64, count=len(matches)
+            )
+        return priorities
+
+    def _wait_priority(self, match, now_ns):
+        created = [t.create_time.ToNanoseconds() for t in match.tickets if t.HasField('create_time')]
+        if not created:
+            return 0.0
+        waited = max(0.0, (now_ns - min(created)) / 1e9)
+        return self.wait_bonus * min(waited, self.wait_cap)
+
+
+DEFAULT_POLICY = PriorityPolicy()
+
+
+def rank_proposals(matches, scores=None, policy=DEFAULT_POLICY):
+    """優先度の高い順の提案番号（同点は到着順）"""
+    if scores is None:
+        now_ns = time.time_ns()
+        scores = [policy.priority(match, now_ns) for match in matches]
+    return sorted(range(len(matches)), key=scores.__getitem__, reverse=True)
+
+
+def _conflict_keys(match):
+    keys = [ticket.id for ticket in match.tickets]
+    if match.HasField('backfill') and match.backfill.id:
+        keys.append(('backfill', match.backfill.id))
+    return keys
+
+
+def select_disjoint(matches, order=None, policy=DEFAULT_POLICY):
+    """order の順に貪欲に採用し、チケット（と Backfill）が重ならない提案の一覧を返す
+
+    チケットID -> 提案番号 のインデックスで、採用した提案と共有する提案を棄却する。
+    ProposalBatch.select と同じ結果を返す参照実装。
+    """
+    index = {}
+    for i, match in enumerate(matches):
+        for key in _conflict_keys(match):
+            index.setdefault(key, []).append(i)
+
+    rejected = bytearray(len(matches))
+    approved = []
+    for i in rank_proposals(matches, policy=policy) if order is None else order:
+        if rejected[i]:
+            continue
+        match = matches[i]
+        approved.append(match)
+        for key in _conflict_keys(match):
+            for other in index.pop(key, ()):
+                rejected[other] = 1
+    return approved
+
+
+class ProposalBatch:
+    """Evaluate ストリームの提案バッファ
+
+    受信中は提案を溜めるだけにし、select でまとめて処理する。チケットID（と Backfill ID）は
+    辞書で密な整数に写像し、提案ごとの参照を CSR 形式（refs / offsets）の numpy 配列にする。
+    重ならない提案の選択は「各チケットで最優先の生存提案」を配列演算で求めるラウンドの繰り返しで、
+    優先度順の貪欲法（select_disjoint）と同じ結果になる。
+    """
+
+    def __init__(self, policy=DEFAULT_POLICY):
+        self.policy = policy
+        self.now_ns = time.time_ns()
+        self.matches = []
+        # select 後: 提案順に並んだ密整数のチケット参照と、提案 i の範囲 offsets[i]:offsets[i + 1]
+        self.refs = None
+        self.offsets = None
+        self.tickets = 0
+        self.rounds = 0
+
+    def __len__(self):
+        return len(self.matches)
+
+    def add(self, match):
+        self.matches.append(match)
+        self.refs = None
+
+    def _index(self):
+        """チケットID -> 密な整数 の写像と CSR 配列を作る"""
+        matches = self.matches
+        keys = [ticket.id for match in matches for ticket in match.tickets]
+        lengths = np.array([len(match.tickets) for match in matches], dtype=np.int64)
+        owners = None
+
+        backfilled = [i for i, match in enumerate(matches) if match.HasField('backfill') and match.backfill.id]
+        if backfilled:
+            # Backfill は提案の末尾に1参照として加え、提案順に並べ直す
+            keys += [('backfill', matches[i].backfill.id) for i in backfilled]
+            owners = np.concatenate([np.repeat(np.arange(len(matches)), lengths), np.array(backfilled)])
+            lengths += np.bincount(backfilled, minlength=len(matches))
+
+        interned = {}
+        refs = np.fromiter((interned.setdefault(key, len(interned)) for key in keys), dtype=np.int64,
+                           count=len(keys))
+        if owners is not None:
+            refs = refs[np.argsort(owners, kind='stable')]
+        self.refs = refs
+        self.offsets = np.zeros(len(matches) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.tickets = len(interned)
+
+    def contention(self):
+        """{チケットを含む提案数: チケット数}（Backfill も1チケットとして数える）"""
+        if self.refs is None:
+            self._index()
+        per_ticket = np.bincount(np.bincount(self.refs, minlength=self.tickets))
+        return collections.Counter({proposals: int(count) for proposals, count in enumerate(per_ticket) if count})
+
+    def select(self, order=None):
+        """order（既定は優先度の高い順）に貪欲に採用し、(採用した提案, 衝突で棄却した数) を返す"""
+        if self.refs is None:
+            self._index()
+        matches = self.matches
+        n = len(matches)
+        if n == 0:
+            return [], 0
+        refs = self.refs
+        offsets = self.offsets
+
+        if order is None:
+            order = np.argsort(-self.policy.priorities(matches, self.now_ns), kind='stable')
+        else:
+            order = np.asarray(order, dtype=np.int64)
+        # rank が小さいほど優先。order に無い提案は rank = n で対象外
+        rank = np.full(n, n, dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        lengths = np.diff(offsets)
+        nonempty = lengths > 0
+        approved = (rank < n) & ~nonempty
+        live = (rank < n) & nonempty
+        taken = np.zeros(self.tickets, dtype=bool)
+
+        if len(refs):
+            owner = np.repeat(np.arange(n), lengths)
+            ref_rank = rank[owner]
+            starts = offsets[:-1][nonempty]
+            # チケットごとに参照をまとめた並び（各ラウンドで最優先の生存提案を求める）
+            by_ticket = np.argsort(refs, kind='stable')
+            ticket_rank = ref_rank[by_ticket]
+            ticket_owner = owner[by_ticket]
+            ticket_starts = np.flatnonzero(np.diff(refs[by_ticket], prepend=-1))
+            best = np.empty(self.tickets, dtype=np.int64)
+            per_proposal = np.zeros(n, dtype=bool)
+
+            self.rounds = 0
+            while self.rounds < SELECT_MAX_ROUNDS and live.any():
+                self.rounds += 1
+                # 全チケットで最優先の生存提案なら、貪欲法でも必ず採用される
+                best[:] = np.minimum.reduceat(np.where(live[ticket_owner], ticket_rank, n), ticket_starts)
+                per_proposal[nonempty] = np.logical_and.reduceat(best[refs] == ref_rank, starts)
+                selected = live & per_proposal
+                approved |= selected
+                live &= ~selected
+                taken[refs[selected[owner]]] = True
+                # 採用済みのチケットを含む提案は棄却
+                per_proposal[nonempty] = np.logical_or.reduceat(taken[refs], starts)
+                live &= ~per_proposal
+
+            remaining = np.flatnonzero(live)
+            for i in remaining[np.argsort(rank[remaining])].tolist():
+                proposal = refs[offsets[i]:offsets[i + 1]]
+                if not taken[proposal].any():
+                    taken[proposal] = True
+                    approved[i] = True
+
+        chosen = np.flatnonzero(approved)
+        approved_matches = [matches[i] for i in chosen[np.argsort(rank[chosen])].tolist()]
+        return approved_matches, n - len(approved_matches)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += count
+        self.sum += value * count
+        self.count += count
+
+    def render(self, name):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class EvaluatorMetrics:
+    """プロセス内の Evaluate 集計（Prometheus テキスト形式で出力する）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.received = collections.Counter()
+        self.approved = collections.Counter()
+        self.conflicts = Histogram((0, 1, 2, 3, 5, 10, 20, 50))
+        self.stream_seconds = Histogram((0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+        self.stream_errors = 0
+
+    def record_batch(self, batch, approved):
+        received = collections.Counter(match.match_profile for match in batch.matches)
+        accepted = collections.Counter(match.match_profile for match in approved)
+        contention = batch.contention()
+        with self._lock:
+            self.received.update(received)
+            self.approved.update(accepted)
+            for proposals, tickets in contention.items():
+                self.conflicts.observe(proposals - 1, tickets)
+
+    def record_stream(self, seconds, failed=False):
+        with self._lock:
+            self.stream_seconds.observe(seconds)
+            if failed:
+                self.stream_errors += 1
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# HELP evaluator_proposals_received_total Proposals received, by match profile.',
+                '# TYPE evaluator_proposals_received_total counter',
+            ]
+            profiles = sorted(self.received)
+            for profile in profiles:
+                lines.append(f'evaluator_proposals_received_total{{profile="{_escape_label(profile)}"}} '
+                             f'{self.received[profile]}')
+            lines += [
+                '# HELP evaluator_proposals_approved_total Proposals approved, by match profile.',
+                '# TYPE evaluator_proposals_approved_total counter',
+            ]
+            for profile in profiles:
+                lines.append(f'evaluator_proposals_approved_total{{profile="{_escape_label(profile)}"}} '
+                             f'{self.approved[profile]}')
+            lines += [
+                '# HELP evaluator_approval_ratio Approved / received proposals since start, by match profile.',
+                '# TYPE evaluator_approval_ratio gauge',
+            ]
+            for profile in profiles:
+                lines.append(f'evaluator_approval_ratio{{profile="{_escape_label(profile)}"}} '
+                             f'{self.approved[profile] / self.received[profile]}')
+            lines += [
+                '# HELP evaluator_ticket_conflicts Competing proposals per ticket in an Evaluate stream.',
+                '# TYPE evaluator_ticket_conflicts histogram',
+            ]
+            lines += self.conflicts.render('evaluator_ticket_conflicts')
+            lines += [
+                '# HELP evaluator_stream_duration_seconds Evaluate stream duration, first request to last response.',
+                '# TYPE evaluator_stream_duration_seconds histogram',
+            ]
+            lines += self.stream_seconds.render('evaluator_stream_duration_seconds')
+            lines += [
+                '# HELP evaluator_stream_errors_total Evaluate streams that failed.',
+                '# TYPE evaluator_stream_errors_total counter',
+                f'evaluator_stream_errors_total {self.stream_errors}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = EvaluatorMetrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics: {format % args}")
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics endpoint on :{port}/metrics (pid {os.getpid()})")
+    return server
+
+
+def evaluate(batch):
+    approved, rejected = batch.select()
+    METRICS.record_batch(batch, approved)
+    logger.info(f"Approved {len(approved)} of {len(batch)} proposals ({rejected} rejected for overlap)")
+    return [evaluator_pb2.EvaluateResponse(match_id=match.match_id) for match in approved]
+
+
 class EvaluatorServicer(evaluator_pb2_grpc.EvaluatorServicer):
 
+    def __init__(self, policy=DEFAULT_POLICY):
+        self.policy = policy
 
     def Evaluate(self, request_iterator, context):
+        start = time.perf_counter()
+        failed = False
         try:
+            # ストリームを全て受け取ってから、重ならない提案だけを返す
+            batch = ProposalBatch(self.policy)
             for request in request_iterator:
-                # マッチ提案をそのまま返す
-                response = evaluator_pb2.EvaluateResponse(
-                    match_id=request.match.match_id
-                )
-                yield response
+                batch.add(request.match)
+            yield from evaluate(batch)
 
         except Exception as e:
+            failed = True
             logger.error(f"Error in Evaluator.Evaluate: {e}", exc_info=True)
             context.set_code(grpc.StatusCode.INTERNAL)
             context.set_details(f'Internal error: {str(e)}')
+        finally:
+            METRICS.record_stream(time.perf_counter() - start, failed)
+
+
+class AsyncEvaluatorServicer(evaluator_pb2_grpc.EvaluatorServicer):
+    """grpc.aio 版。ストリームごとにスレッドを占有せず、選択処理は executor で行う"""
+
+    def __init__(self, executor, max_concurrent_streams, policy=DEFAULT_POLICY):
+        self.policy = policy
+        self._executor = executor
+        self._limit = asyncio.Semaphore(max_concurrent_streams)
+
+    async def Evaluate(self, request_iterator, context):
+        async with self._limit:
+            start = time.perf_counter()
+            failed = False
+            try:
+                batch = ProposalBatch(self.policy)
+                async for request in request_iterator:
+                    batch.add(request.match)
+                loop = asyncio.get_running_loop()
+                for response in await loop.run_in_executor(self._executor, evaluate, batch):
+                    yield response
 
+            except Exception as e:
+                failed = True
+                logger.error(f"Error in Evaluator.Evaluate: {e}", exc_info=True)
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details(f'Internal error: {str(e)}')
+            finally:
+                METRICS.record_stream(time.perf_counter() - start, failed)
 
-def serve_grpc(port=50508):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+
+async def _serve_worker_async(port, threads, max_concurrent_streams, metrics_port):
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    executor = futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='evaluate')
+    server = grpc.aio.server(options=[('grpc.so_reuseport', 1)])
+
+    evaluator_pb2_grpc.add_EvaluatorServicer_to_server(
+        AsyncEvaluatorServicer(executor, max_concurrent_streams), server
+    )
+
+    server.add_insecure_port(f'[::]:{port}')
+
+    logger.info(f"Evaluator grpc.aio server starting on port {port} (pid {os.getpid()}, "
+                f"executor threads {threads}, max concurrent streams {max_concurrent_streams})")
+    await server.start()
+
+    logger.info("Evaluator server ready")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down...")
+    await server.stop(grace=5)
+    executor.shutdown(wait=False)
+
+
+def _serve_worker(port, threads, use_aio=False, max_concurrent_streams=100, metrics_port=METRICS_PORT):
+    if use_aio:
+        asyncio.run(_serve_worker_async(port, threads, max_concurrent_streams, metrics_port))
+        return
+
+    if metrics_port:
+        start_metrics_server(metrics_port)
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=threads),
+        options=[('grpc.so_reuseport', 1)]
+    )
 
     evaluator_pb2_grpc.add_EvaluatorServicer_to_server(
         EvaluatorServicer(), server
@@ -45,27 +513,78 @@ def serve_grpc(port=50508):
 
     server.add_insecure_port(f'[::]:{port}')
 
-    logger.info(f"Evaluator gRPC server starting on port {port}")
+    logger.info(f"Evaluator gRPC server starting on port {port} (pid {os.getpid()}, threads {threads})")
     server.start()
 
     logger.info("Evaluator server ready")
 
-    try:
-        server.wait_for_termination()
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
-        server.stop(grace=5)
+    # SIGTERM / SIGINT で新規RPCの受付を止め、処理中のRPCを待ってから終了する
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    stop.wait()
+
+    logger.info("Shutting down...")
+    server.stop(grace=5).wait()
+
+
+def serve_grpc(port=50508, workers=1, threads=10, use_aio=False, max_concurrent_streams=100,
+               metrics_port=METRICS_PORT):
+    if workers <= 1:
+        _serve_worker(port, threads, use_aio, max_concurrent_streams, metrics_port)
+        return
+
+    # プリフォーク: 同じポートに SO_REUSEPORT で bind したワーカープロセスを起動する
+    # （gRPC のチャネル・サーバーは fork 前に作らない）
+    processes = []
+    for i in range(workers):
+        process = multiprocessing.Process(
+            target=_serve_worker,
+            args=(port, threads, use_aio, max_concurrent_streams, metrics_port + i if metrics_port else 0)
+        )
+        process.start()
+        processes.append(process)
+    logger.info(f"Started {workers} Evaluator workers on port {port}: {[p.pid for p in processes]}")
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            logger.warning(f"Worker {process.pid} exited with code {process.exitcode}")
+    logger.info("All workers stopped")
 
 
 if __name__ == '__main__':
     import argparse
 
-    parser = argparse.ArgumentParser(description='OpenMatch Pass-through Evaluator (gRPC)')
+    parser = argparse.ArgumentParser(description='OpenMatch Evaluator (gRPC)')
     parser.add_argument('--port', type=int, default=50508, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('GRPC_WORKERS', '1')),
+                        help='Number of server processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('GRPC_THREADS', '10')),
+                        help='Handler threads per server process (executor threads with --aio)')
+    parser.add_argument('--aio', action='store_true', default=os.getenv('GRPC_AIO', 'false').lower() == 'true',
+                        help='Serve with grpc.aio (asyncio) instead of a thread-per-stream server')
+    parser.add_argument('--max-concurrent-streams', type=int,
+                        default=int(os.getenv('MAX_CONCURRENT_STREAMS', '100')),
+                        help='Evaluate streams processed at once with --aio (the rest wait their turn)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='Port for Prometheus /metrics (worker i uses port + i, 0 disables)')
 
     args = parser.parse_args()
 
     logger.info("Starting Evaluator gRPC server...")
     logger.info(f"Port: {args.port}")
+    logger.info(f"Workers: {args.workers}, threads per worker: {args.threads}")
+    logger.info(f"Server: {'grpc.aio' if args.aio else 'grpc (sync)'}")
+    logger.info(f"Priority: profile weights {DEFAULT_POLICY.weights or '{}'} (default {EVALUATOR_DEFAULT_WEIGHT}), "
+                f"wait bonus {EVALUATOR_WAIT_BONUS}/s up to {EVALUATOR_WAIT_CAP}s")
 
-    serve_grpc(args.port)
+    serve_grpc(args.port, args.workers, args.threads, args.aio, args.max_concurrent_streams, args.metrics_port)
@@ -1,24 +1,35 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
 import os
 import sys
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
 import grpc
-from typing import Optional
-import jwt
+from typing import Optional, Tuple
+from calendar import timegm
 from datetime import datetime, timedelta
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.backends import default_backend
 import base64
+import functools
+import hashlib
+import hmac
 import json
+import itertools
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 
 sys.path.insert(0, os.path.dirname(__file__))
 
 from protos.api import frontend_pb2
 from protos.api import frontend_pb2_grpc
 from protos.api import messages_pb2
+from google.protobuf import any_pb2, wrappers_pb2
 
 logging.basicConfig(
     level=logging.INFO,
@@ -35,16 +46,92 @@ ASSIGNMENT_TIMEOUT = int(os.getenv('ASSIGNMENT_TIMEOUT', '60'))
 BEARER_TOKEN = os.getenv('BEARER_TOKEN', 'secret-token-12345')
 PORT = int(os.getenv('PORT', '8080'))
 JWT_EXPIRATION_MINUTES = int(os.getenv('JWT_EXPIRATION_MINUTES', '60'))
-
-app = Flask(__name__)
+# Open Match Frontend へのチャネル数（全リクエストで共有）
+FRONTEND_CHANNELS = int(os.getenv('FRONTEND_CHANNELS', '4'))
+# 同時に WatchAssignments するチケット数の上限（超えたら 503）
+MAX_WAITING_TICKETS = int(os.getenv('MAX_WAITING_TICKETS', '10000'))
+# WatchAssignments がアサイン前に切れたときの張り直し間隔（指数バックオフ）
+WATCH_RETRY_MIN = float(os.getenv('WATCH_RETRY_MIN', '0.2'))
+WATCH_RETRY_MAX = float(os.getenv('WATCH_RETRY_MAX', '5'))
+# 解決済みアサインを再接続・再試行のために保持する件数と秒数
+ASSIGNMENT_CACHE_SIZE = int(os.getenv('ASSIGNMENT_CACHE_SIZE', '10000'))
+ASSIGNMENT_CACHE_TTL = float(os.getenv('ASSIGNMENT_CACHE_TTL', '60'))
+# POST /tickets で作成したチケットを覚えておく件数（超えたら古い順に忘れ、GetTicket で引き直す）
+TICKET_REGISTRY_SIZE = int(os.getenv('TICKET_REGISTRY_SIZE', '100000'))
+# 作成したチケットの寿命。待機者がいないまま過ぎたチケットはスイーパーが DeleteTicket する
+TICKET_TTL = float(os.getenv('TICKET_TTL', str(ASSIGNMENT_TIMEOUT + 60)))
+TICKET_SWEEP_INTERVAL = float(os.getenv('TICKET_SWEEP_INTERVAL', '5'))
+# 1回の掃除で並行に DeleteTicket する件数
+TICKET_SWEEP_BATCH = int(os.getenv('TICKET_SWEEP_BATCH', '100'))
+# 再試行で同じチケットに戻すための冪等キー: Idempotency-Key ヘッダ、無ければ PLAYER_ID_HEADER のプレイヤーID
+PLAYER_ID_HEADER = os.getenv('PLAYER_ID_HEADER', 'X-Player-Id')
+# プレイヤーIDは認証されないので、プレイヤーIDでの再接続にはこのヘッダで作成時の購読トークンを求める
+SUBSCRIPTION_TOKEN_HEADER = os.getenv('SUBSCRIPTION_TOKEN_HEADER', 'X-Subscription-Token')
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', str(TICKET_TTL)))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', str(TICKET_REGISTRY_SIZE)))
+# 同じホストの複数レプリカで共有する sqlite ファイル（空ならプロセス内のみ）
+IDEMPOTENCY_DB = os.getenv('IDEMPOTENCY_DB', '')
+# 冪等キー付きの /play が切断されてからチケットを削除するまでの猶予（この間の再試行は同じチケットに戻る）
+DISCONNECT_GRACE = float(os.getenv('DISCONNECT_GRACE', '10'))
+# SSE のキープアライブ間隔（プロキシのアイドルタイムアウトより短くする）
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+# /tickets/<id>/events の購読トークンのハッシュを入れるチケットの persistent_field キー
+SUBSCRIPTION_FIELD = 'subscription'
+
+app = Quart(__name__)
 
 PRIVATE_KEY = None
 PUBLIC_KEY = None
 PUBLIC_KEY_PEM = None
+JWT_ISSUER = None
+
+
+def _b64url(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+class JWTIssuer:
+    """RS256 の JWT 発行
+
+    署名鍵はオブジェクトのまま保持し、ヘッダ部（base64url）は一度だけ作る。
+    PEM への直列化と jwt.encode での再パースを毎回行わない。出力は jwt.encode と同じ形式。
+    """
+
+    def __init__(self, private_key, expiration_minutes=JWT_EXPIRATION_MINUTES):
+        self.private_key = private_key
+        self.expiration = timedelta(minutes=expiration_minutes)
+        self.header = _b64url(json.dumps({'alg': 'RS256', 'typ': 'JWT'}, separators=(',', ':'),
+                                         sort_keys=True).encode()) + b'.'
+        self._padding = padding.PKCS1v15()
+        self._hash = hashes.SHA256()
+
+    def _sign(self, payload: dict) -> str:
+        signing_input = self.header + _b64url(json.dumps(payload, separators=(',', ':')).encode())
+        signature = self.private_key.sign(signing_input, self._padding, self._hash)
+        return (signing_input + b'.' + _b64url(signature)).decode()
+
+    def issue(self, ticket_id: str, server_info: dict, player_info: dict, now: Optional[datetime] = None) -> str:
+        return self.issue_many([(ticket_id, server_info, player_info)], now)[0]
+
+    def issue_many(self, claims: list, now: Optional[datetime] = None) -> list:
+        """[(ticket_id, server_info, player_info), ...] をまとめて署名する（同じ iat / exp）"""
+        now = now or datetime.utcnow()
+        iat = timegm(now.utctimetuple())
+        exp = timegm((now + self.expiration).utctimetuple())
+        return [
+            self._sign({
+                'ticket_id': ticket_id,
+                'server': server_info,
+                'player': player_info,
+                'iat': iat,
+                'exp': exp
+            })
+            for ticket_id, server_info, player_info in claims
+        ]
 
 
 def generate_rsa_keypair():
-    global PRIVATE_KEY, PUBLIC_KEY, PUBLIC_KEY_PEM
+    global PRIVATE_KEY, PUBLIC_KEY, PUBLIC_KEY_PEM, JWT_ISSUER
 
     logger.info("Generating RSA key pair...")
 
@@ -61,6 +148,8 @@ def generate_rsa_keypair():
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     )
 
+    JWT_ISSUER = JWTIssuer(PRIVATE_KEY)
+
     logger.info("RSA key pair generated successfully")
 
 
@@ -78,27 +167,25 @@ def check_auth(auth_header: Optional[str]) -> bool:
 
 def generate_jwt(ticket_id: str, server_info: dict, player_info: dict) -> str:
     """JWT生成"""
-    now = datetime.utcnow()
-    expiration = now + timedelta(minutes=JWT_EXPIRATION_MINUTES)
+    return JWT_ISSUER.issue(ticket_id, server_info, player_info)
 
-    payload = {
-        'ticket_id': ticket_id,
-        'server': server_info,
-        'player': player_info,
-        'iat': now,
-        'exp': expiration
-    }
 
-    private_pem = PRIVATE_KEY.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-    token = jwt.encode(payload, private_pem, algorithm='RS256')
-    return token
+def subscription_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def check_subscription(ticket: messages_pb2.Ticket, token: Optional[str]) -> bool:
+    """購読トークンがチケット作成時のものか（チケットにはハッシュだけを持たせる）"""
+    if not token or SUBSCRIPTION_FIELD not in ticket.persistent_field:
+        return False
+    stored = wrappers_pb2.BytesValue()
+    if not ticket.persistent_field[SUBSCRIPTION_FIELD].Unpack(stored):
+        return False
+    return hmac.compare_digest(stored.value, subscription_digest(token))
 
 
-def create_ticket(region: str) -> messages_pb2.Ticket:
+def create_ticket(region: str, player_id: Optional[str] = None,
+                  subscription: Optional[str] = None) -> messages_pb2.Ticket:
     """チケット作成"""
     import random
     import time
@@ -119,41 +206,507 @@ def create_ticket(region: str) -> messages_pb2.Ticket:
             }
         )
     )
+    if player_id:
+        # マッチファンクションの再戦回避・ブロックリストが参照する
+        ticket.search_fields.string_args["player_id"] = player_id
+    if subscription:
+        # どのレプリカでも /events の購読トークンを検証できるよう、ハッシュをチケットに載せる
+        digest = any_pb2.Any()
+        digest.Pack(wrappers_pb2.BytesValue(value=subscription_digest(subscription)))
+        ticket.persistent_field[SUBSCRIPTION_FIELD].CopyFrom(digest)
     return ticket
 
 
-def get_assignment(ticket_id: str) -> Optional[dict]:
-    """アサインメント取得"""
-    try:
-        channel = grpc.insecure_channel(OPEN_MATCH_FRONTEND_SERVICE)
-        stub = frontend_pb2_grpc.FrontendServiceStub(channel)
+class TooManyWaiters(Exception):
+    """MAX_WAITING_TICKETS を超えてアサイン待ちを受け付けようとした"""
+
+
+class _Watch:
+    __slots__ = ('future', 'task', 'waiters')
+
+    def __init__(self, future):
+        self.future = future
+        self.task = None
+        self.waiters = 0
+
+
+class AssignmentDispatcher:
+    """フロントエンド全体で共有するアサイン待ちの多重化
+
+    - Open Match Frontend への grpc.aio チャネルを channels 本だけ持ち、順番に使う
+    - WatchAssignments はチケットごとに1本だけ張り、同じチケットの待機者は同じ Future を await する
+    - アサイン前に切れたストリームは張り直し、待機者が全員いなくなった（タイムアウト・切断）らキャンセルする
+    - 解決済みのアサインは cache_size 件・cache_ttl 秒だけ保持し、再接続に返す
+    """
+
+    def __init__(self, target=OPEN_MATCH_FRONTEND_SERVICE, channels=FRONTEND_CHANNELS,
+                 max_waiting=MAX_WAITING_TICKETS, cache_size=ASSIGNMENT_CACHE_SIZE, cache_ttl=ASSIGNMENT_CACHE_TTL):
+        self.target = target
+        self.channel_count = max(1, channels)
+        self.max_waiting = max_waiting
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._channels = []
+        self._stubs = None
+        self._watches = {}
+        self._resolved = OrderedDict()
+
+    async def start(self):
+        # grpc.aio のチャネルはイベントループ上で作る
+        self._channels = [grpc.aio.insecure_channel(self.target) for _ in range(self.channel_count)]
+        self._stubs = itertools.cycle([frontend_pb2_grpc.FrontendServiceStub(c) for c in self._channels])
+
+    async def close(self):
+        for watch in list(self._watches.values()):
+            watch.task.cancel()
+        for channel in self._channels:
+            await channel.close()
+        self._channels = []
+
+    def stub(self):
+        return next(self._stubs)
+
+    def __len__(self):
+        return len(self._watches)
+
+    def resolved(self, ticket_id: str) -> Optional[dict]:
+        entry = self._resolved.get(ticket_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self._resolved[ticket_id]
+            return None
+        return entry[0]
+
+    def _remember(self, ticket_id, assignment):
+        self._resolved[ticket_id] = (assignment, time.monotonic() + self.cache_ttl)
+        self._resolved.move_to_end(ticket_id)
+        while len(self._resolved) > self.cache_size:
+            self._resolved.popitem(last=False)
+
+    async def _watch(self, ticket_id, watch):
+        assignment = None
+        retry_delay = WATCH_RETRY_MIN
+        try:
+            watch_request = frontend_pb2.WatchAssignmentsRequest(ticket_id=ticket_id)
+            # ストリームがアサイン前に切れたら、待機者がいる限り（wait がキャンセルするまで）張り直す
+            while assignment is None:
+                try:
+                    async for response in self.stub().WatchAssignments(watch_request):
+                        if response.assignment and response.assignment.connection:
+                            connection = response.assignment.connection
+                            parts = connection.split(':')
+                            assignment = {
+                                'ip': parts[0],
+                                'port': parts[1] if len(parts) > 1 else '',
+                                'connection': connection
+                            }
+                            self._remember(ticket_id, assignment)
+                            break
+                    else:
+                        logger.warning(f"Assignment watch for {ticket_id} ended early, retrying")
+                except grpc.RpcError as e:
+                    if e.code() == grpc.StatusCode.NOT_FOUND:
+                        logger.warning(f"Ticket {ticket_id} no longer exists")
+                        break
+                    logger.error(f"gRPC error watching {ticket_id}: {e.code()} - {e.details()}")
+                if assignment is None:
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, WATCH_RETRY_MAX)
+        except Exception as e:
+            logger.error(f"Error getting assignment: {e}", exc_info=True)
+        finally:
+            if self._watches.get(ticket_id) is watch:
+                del self._watches[ticket_id]
+            if not watch.future.done():
+                watch.future.set_result(assignment)
+
+    async def wait(self, ticket_id: str, timeout: float) -> Optional[dict]:
+        """アサインを待つ。timeout 秒で None。待機側のキャンセル（クライアント切断）はそのまま伝播する"""
+        assignment = self.resolved(ticket_id)
+        if assignment is not None:
+            return assignment
+
+        watch = self._watches.get(ticket_id)
+        if watch is None:
+            if len(self._watches) >= self.max_waiting:
+                raise TooManyWaiters(f'{len(self._watches)} tickets already waiting for assignment')
+            watch = self._watches[ticket_id] = _Watch(asyncio.get_running_loop().create_future())
+            watch.task = asyncio.create_task(self._watch(ticket_id, watch))
+
+        watch.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(watch.future), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timeout waiting for assignment: {ticket_id}")
+            return None
+        finally:
+            watch.waiters -= 1
+            if watch.waiters == 0 and not watch.future.done():
+                watch.task.cancel()
+
+
+dispatcher = AssignmentDispatcher()
+
+
+async def get_assignment(ticket_id: str) -> Optional[dict]:
+    """アサインメント取得（待機中のプレイヤーはスレッドではなくコルーチン1つを占有する）"""
+    return await dispatcher.wait(ticket_id, ASSIGNMENT_TIMEOUT)
+
+
+class IdempotencyStore:
+    """冪等キー -> 生きているチケットIDと購読トークン（TTL + LRU）
+
+    キーは 'key:<Idempotency-Key>' または 'player:<プレイヤーID>'。
+    再試行で同じチケットに戻ったクライアントには、作成時と同じ購読トークンを返す。
+    path を指定すると sqlite にも書き、同じホストの他のレプリカと共有する。
+    claim は put-if-absent なので、同時に作成されたチケットは1つに収束する。
+    path を指定したときはメモリ上の表はキャッシュに過ぎず、get は毎回 sqlite を引き直す
+    （他のレプリカが外したキーを返さない）。sqlite の読み書きはすべてスレッドで行う。
+    """
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_size=IDEMPOTENCY_CACHE_SIZE, path=IDEMPOTENCY_DB):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._releases = set()
+        if path:
+            self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS idempotency '
+                             '(key TEXT PRIMARY KEY, ticket_id TEXT NOT NULL, expires_at REAL NOT NULL, '
+                             "token TEXT NOT NULL DEFAULT '')")
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(idempotency)')}
+            if 'token' not in columns:
+                try:
+                    self._db.execute("ALTER TABLE idempotency ADD COLUMN token TEXT NOT NULL DEFAULT ''")
+                except sqlite3.OperationalError:
+                    # 他のレプリカが同時に列を追加した
+                    if 'token' not in {row[1] for row in self._db.execute('PRAGMA table_info(idempotency)')}:
+                        raise
+            self._db.execute('CREATE INDEX IF NOT EXISTS idempotency_ticket ON idempotency (ticket_id)')
+
+    def _remember(self, key, ticket_id, token, expires_at):
+        self._entries[key] = (ticket_id, token, expires_at)
+        self._entries.move_to_end(key)
+        self._keys[ticket_id] = key
+        while len(self._entries) > self.max_size:
+            _, (evicted, _, _) = self._entries.popitem(last=False)
+            self._keys.pop(evicted, None)
+
+    def _db_get(self, key, now):
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT ticket_id, token, expires_at FROM idempotency WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+        return row
+
+    def _db_claim(self, key, ticket_id, token, now, expires_at):
+        with self._db_lock:
+            self._db.execute(
+                'INSERT INTO idempotency (key, ticket_id, token, expires_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET ticket_id = excluded.ticket_id, token = excluded.token, '
+                'expires_at = excluded.expires_at WHERE idempotency.expires_at <= ?',
+                (key, ticket_id, token, expires_at, now)
+            )
+            return self._db.execute('SELECT ticket_id, token, expires_at FROM idempotency WHERE key = ?',
+                                    (key,)).fetchone()
+
+    def _db_release(self, key, ticket_id, players_only):
+        with self._db_lock:
+            if key is not None:
+                self._db.execute('DELETE FROM idempotency WHERE key = ? AND ticket_id = ?', (key, ticket_id))
+            elif players_only:
+                self._db.execute("DELETE FROM idempotency WHERE ticket_id = ? AND key LIKE 'player:%'", (ticket_id,))
+            else:
+                self._db.execute('DELETE FROM idempotency WHERE ticket_id = ?', (ticket_id,))
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._keys.get(entry[0]) == key:
+            del self._keys[entry[0]]
+
+    async def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """(チケットID, 購読トークン)"""
+        now = time.time()
+        if self._db is None:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > now:
+                return entry[0], entry[1]
+            return None
+        row = await asyncio.to_thread(self._db_get, key, now)
+        if row is None:
+            self._forget(key)
+            return None
+        self._remember(key, *row)
+        return row[0], row[1]
+
+    async def claim(self, key: str, ticket_id: str, token: str) -> Tuple[str, str]:
+        """key に ticket_id を登録する。既に生きているチケットがあればそちらの (ID, 購読トークン) を返す"""
+        now = time.time()
+        expires_at = now + self.ttl
+        if self._db is not None:
+            ticket_id, token, expires_at = await asyncio.to_thread(
+                self._db_claim, key, ticket_id, token, now, expires_at
+            )
+        else:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > now:
+                ticket_id, token, expires_at = entry
+        self._remember(key, ticket_id, token, expires_at)
+        return ticket_id, token
+
+    def _release_local(self, ticket_id, players_only):
+        """メモリ上のキーを外し、sqlite からの削除（スレッドで呼ぶ関数）を返す。何も消さないなら None"""
+        key = self._keys.get(ticket_id)
+        if key is not None:
+            if players_only and not key.startswith('player:'):
+                return None
+            del self._keys[ticket_id]
+            if self._entries.get(key, (None,))[0] == ticket_id:
+                del self._entries[key]
+        if self._db is None:
+            return None
+        # 他のレプリカが登録したキーはメモリに無いので、チケットIDで消す
+        return functools.partial(self._db_release, key, ticket_id, players_only)
+
+    async def release(self, ticket_id: str, players_only=False):
+        """チケットが終わったらキーを外し、次の要求で新しいチケットを作らせる"""
+        delete = self._release_local(ticket_id, players_only)
+        if delete is not None:
+            await asyncio.to_thread(delete)
+
+    def release_soon(self, ticket_id: str, players_only=False):
+        """同期コードから呼ぶ release。メモリからはすぐ外し、sqlite の削除はバックグラウンドで行う"""
+        delete = self._release_local(ticket_id, players_only)
+        if delete is not None:
+            task = asyncio.get_running_loop().create_task(asyncio.to_thread(delete))
+            self._releases.add(task)
+            task.add_done_callback(self._releases.discard)
+
+
+idempotency = IdempotencyStore()
+
+
+def idempotency_key() -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """(冪等キー, プレイヤーID, 提示された購読トークン)"""
+    player_id = request.headers.get(PLAYER_ID_HEADER) or None
+    proof = request.headers.get(SUBSCRIPTION_TOKEN_HEADER) or None
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        return f'key:{key}', player_id, proof
+    if player_id:
+        return f'player:{player_id}', player_id, proof
+    return None, None, proof
+
+
+def may_reattach(key: str, token: str, proof: Optional[str]) -> bool:
+    """既存チケットに戻してよいか
+
+    Idempotency-Key はクライアントだけが知る値だが、プレイヤーIDは誰でも名乗れるので、
+    player キーでは作成時の購読トークンを提示した場合だけ戻す（他人のトークン・JWT を渡さない）。
+    """
+    if not key.startswith('player:'):
+        return True
+    return bool(token and proof) and hmac.compare_digest(token.encode(), proof.encode())
+
+
+class TicketRegistry:
+    """このフロントエンドが作成したまま未マッチのチケット
+
+    作成順（= 期限順）の OrderedDict に (Ticket, 期限) を持つ。
+    タイムアウト・切断したチケットと期限切れのチケットは due() で削除対象として取り出す。
+    上限を超えて押し出したチケットは追跡をやめるだけで削除しない（まだ待機者がいるかもしれない）。
+    """
+
+    def __init__(self, max_size=TICKET_REGISTRY_SIZE, ttl=TICKET_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._tickets = OrderedDict()
+        self._abandoned = []
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def add(self, ticket):
+        self._tickets[ticket.id] = (ticket, time.monotonic() + self.ttl)
+        self._tickets.move_to_end(ticket.id)
+        while len(self._tickets) > self.max_size:
+            evicted, _ = self._tickets.popitem(last=False)
+            logger.warning(f"Ticket registry is full, no longer tracking ticket {evicted}")
+
+    def get(self, ticket_id: str) -> Optional[messages_pb2.Ticket]:
+        entry = self._tickets.get(ticket_id)
+        return entry[0] if entry is not None else None
+
+    def complete(self, ticket_id: str):
+        """マッチしたチケットは追跡をやめる（Idempotency-Key の再試行にはアサインを返し続ける）"""
+        self._tickets.pop(ticket_id, None)
+        idempotency.release_soon(ticket_id, players_only=True)
+
+    def abandon(self, ticket_id: str):
+        """待機者がいなくなったチケットを次の掃除で削除する（他のレプリカが作成したものも含む）"""
+        self._tickets.pop(ticket_id, None)
+        self._abandoned.append(ticket_id)
+        idempotency.release_soon(ticket_id)
+
+    def abandon_later(self, ticket_id: str, delay: float):
+        """delay 秒後に期限切れにする（その前に add されれば延命）"""
+        entry = self._tickets.get(ticket_id)
+        if entry is None:
+            return
+        self._tickets[ticket_id] = (entry[0], time.monotonic() + delay)
+        # 先頭ほど期限が早い前提なので先頭に回す（後ろの期限切れは最大 delay 秒遅れる）
+        self._tickets.move_to_end(ticket_id, last=False)
+
+    def due(self, limit: int) -> list:
+        """削除すべきチケットID（放棄済み, 期限切れの順に最大 limit 件）"""
+        due, self._abandoned = self._abandoned[:limit], self._abandoned[limit:]
+        now = time.monotonic()
+        while len(due) < limit and self._tickets:
+            ticket_id, (_, expires_at) = next(iter(self._tickets.items()))
+            if expires_at > now:
+                break
+            del self._tickets[ticket_id]
+            due.append(ticket_id)
+        return due
+
+
+tickets = TicketRegistry()
+
+
+async def delete_tickets(ticket_ids: list) -> int:
+    """DeleteTicket を並行に投げ、削除できた件数を返す（既に無いチケットは削除済みとみなす）"""
+    async def delete(ticket_id):
+        try:
+            await dispatcher.stub().DeleteTicket(frontend_pb2.DeleteTicketRequest(ticket_id=ticket_id), timeout=10)
+            return True
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                return True
+            logger.error(f"Failed to delete ticket {ticket_id}: {e.code()} - {e.details()}")
+            return False
+
+    return sum(await asyncio.gather(*(delete(ticket_id) for ticket_id in ticket_ids)))
 
-        watch_request = frontend_pb2.WatchAssignmentsRequest(ticket_id=ticket_id)
 
+async def sweep_tickets():
+    """放棄・期限切れのチケットを TICKET_SWEEP_BATCH 件ずつ削除し続ける"""
+    while True:
+        await asyncio.sleep(TICKET_SWEEP_INTERVAL)
         try:
-            response_iterator = stub.WatchAssignments(watch_request, timeout=ASSIGNMENT_TIMEOUT)
-            for response in response_iterator:
-                if response.assignment and response.assignment.connection:
-                    connection = response.assignment.connection
-                    parts = connection.split(':')
-                    channel.close()
-                    return {
-                        'ip': parts[0],
-                        'port': parts[1] if len(parts) > 1 else '',
-                        'connection': connection
-                    }
-        except grpc.RpcError as e:
-            if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
-                logger.warning(f"Timeout waiting for assignment: {ticket_id}")
-            else:
-                logger.error(f"gRPC error: {e.code()} - {e.details()}")
+            while True:
+                due = tickets.due(TICKET_SWEEP_BATCH)
+                if not due:
+                    break
+                deleted = await delete_tickets(due)
+                logger.info(f"Swept {deleted}/{len(due)} abandoned or expired tickets ({len(tickets)} still tracked)")
+        except Exception as e:
+            logger.error(f"Error sweeping tickets: {e}", exc_info=True)
+
+
+async def open_ticket(region: str, key: Optional[str] = None, player_id: Optional[str] = None,
+                      proof: Optional[str] = None) -> Tuple[messages_pb2.Ticket, str, bool]:
+    """チケットを作成して Open Match に登録する。(チケット, 購読トークン, 新規作成か) を返す
+
+    冪等キーに生きているチケットがあれば、作成せずにそのチケットと作成時の購読トークンを返す（再試行の再接続）。
+    player キーの場合は proof が作成時の購読トークンと一致するときだけ戻し、それ以外は別のチケットを作る。
+    """
+    if key:
+        entry = await idempotency.get(key)
+        if entry:
+            ticket_id, token = entry
+            ticket = await find_ticket(ticket_id)
+            if ticket is None:
+                await idempotency.release(ticket_id)
+            elif may_reattach(key, token, proof):
+                tickets.add(ticket)
+                logger.info(f"Reattached to ticket {ticket_id} for {key}")
+                return ticket, token, False
+
+    token = secrets.token_urlsafe(32)
+    req = frontend_pb2.CreateTicketRequest(ticket=create_ticket(region, player_id, token))
+    ticket = await dispatcher.stub().CreateTicket(request=req, timeout=10)
+    tickets.add(ticket)
+    logger.info(f"Created ticket: {ticket.id}, region: {region}")
+
+    if key:
+        winner, winner_token = await idempotency.claim(key, ticket.id, token)
+        if winner != ticket.id:
+            if not may_reattach(key, winner_token, proof):
+                # 持ち主と確かめられないので既存のチケットには触れず、このチケットを冪等キー無しで使う
+                logger.info(f"Not reattaching to ticket {winner} for {key} without its subscription token")
+                return ticket, token, True
+            # 同時に作られた別のチケットに合流し、こちらは削除する
+            existing = await find_ticket(winner)
+            if existing is not None:
+                tickets.abandon(ticket.id)
+                logger.info(f"Reattached to ticket {winner} for {key}, discarding {ticket.id}")
+                return existing, winner_token, False
+            await idempotency.release(winner)
+            await idempotency.claim(key, ticket.id, token)
+    return ticket, token, True
+
+
+async def find_ticket(ticket_id: str) -> Optional[messages_pb2.Ticket]:
+    """作成済みチケット。他のレプリカが作成したもの・追跡を外れたものは GetTicket で引く"""
+    ticket = tickets.get(ticket_id)
+    if ticket is not None:
+        return ticket
+    try:
+        return await dispatcher.stub().GetTicket(frontend_pb2.GetTicketRequest(ticket_id=ticket_id), timeout=10)
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.NOT_FOUND:
+            return None
+        raise
 
-        channel.close()
-        return None
 
-    except Exception as e:
-        logger.error(f"Error getting assignment: {e}", exc_info=True)
-        return None
+def ticket_player_info(ticket: messages_pb2.Ticket) -> dict:
+    return {
+        'skill': ticket.search_fields.double_args['skill'],
+        'latency': ticket.search_fields.double_args['latency'],
+        'region': ticket.search_fields.string_args['region']
+    }
+
+
+def matched_result(ticket: messages_pb2.Ticket, assignment: dict) -> dict:
+    server_info = {
+        'ip': assignment['ip'],
+        'port': assignment['port'],
+        'connection': assignment['connection']
+    }
+    player = ticket_player_info(ticket)
+
+    # JWT生成
+    access_token = generate_jwt(ticket.id, server_info, player)
+
+    tickets.complete(ticket.id)
+    logger.info(f"Match found for ticket {ticket.id}: {assignment['connection']}")
+    return {
+        'status': 'matched',
+        'ticket_id': ticket.id,
+        'server': server_info,
+        'player': player,
+        'jwt': access_token
+    }
+
+
+def timeout_result(ticket_id: str) -> dict:
+    # 待ちきれなかったチケットはプールに残さない
+    tickets.abandon(ticket_id)
+    logger.warning(f"Timeout for ticket {ticket_id}")
+    return {
+        'status': 'timeout',
+        'ticket_id': ticket_id,
+        'message': 'No match found within timeout period'
+    }
+
+
+def sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
 
 
 def get_jwks():
@@ -175,74 +728,101 @@ def get_jwks():
     return {'keys': [jwk]}
 
 
+@app.before_serving
+async def start_dispatcher():
+    await dispatcher.start()
+    app.sweeper = asyncio.create_task(sweep_tickets())
+
+
+@app.after_serving
+async def stop_dispatcher():
+    app.sweeper.cancel()
+    await dispatcher.close()
+
+
 @app.route('/.well-known/jwks.json', methods=['GET'])
-def jwks():
+async def jwks():
     """公開鍵をJWKS形式で返す"""
     return jsonify(get_jwks()), 200
 
 
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """ヘルスチェック"""
     return jsonify({'status': 'ok'}), 200
 
 
 @app.route('/play/<region>', methods=['GET'])
-def play(region: str):
+async def play(region: str):
     """マッチング開始"""
     # 認証チェック
     auth_header = request.headers.get('Authorization')
     if not check_auth(auth_header):
         return jsonify({'error': 'Unauthorized'}), 401
 
+    if len(dispatcher) >= dispatcher.max_waiting:
+        return jsonify({'error': 'Too many players waiting, retry later'}), 503
+
     try:
-        # チケット作成
-        ticket = create_ticket(region)
+        # チケット作成（同じプレイヤー・冪等キーの再試行は既存チケットの待機に戻る）
+        key, player_id, proof = idempotency_key()
+        ticket, _, _ = await open_ticket(region, key, player_id, proof)
 
-        channel = grpc.insecure_channel(OPEN_MATCH_FRONTEND_SERVICE)
-        stub = frontend_pb2_grpc.FrontendServiceStub(channel)
+        # アサインメント待機（クライアントが切断したらチケットを放棄する）
+        try:
+            assignment = await get_assignment(ticket.id)
+        except asyncio.CancelledError:
+            if key:
+                tickets.abandon_later(ticket.id, DISCONNECT_GRACE)
+            else:
+                tickets.abandon(ticket.id)
+            logger.info(f"Client disconnected, abandoning ticket {ticket.id}")
+            raise
+        except TooManyWaiters:
+            tickets.abandon(ticket.id)
+            raise
 
-        req = frontend_pb2.CreateTicketRequest(ticket=ticket)
-        resp = stub.CreateTicket(request=req, timeout=10)
-        ticket_id = resp.id
+        if assignment:
+            return jsonify(matched_result(ticket, assignment)), 200
+        else:
+            return jsonify(timeout_result(ticket.id)), 408
 
-        logger.info(f"Created ticket: {ticket_id}, region: {region}")
+    except TooManyWaiters as e:
+        logger.warning(f"Rejecting player: {e}")
+        return jsonify({'error': 'Too many players waiting, retry later'}), 503
+    except grpc.RpcError as e:
+        logger.error(f"gRPC error: {e.code()} - {e.details()}")
+        return jsonify({'error': f'gRPC error: {e.details()}'}), 500
+    except Exception as e:
+        logger.error(f"Error: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        # アサインメント待機
-        assignment = get_assignment(ticket_id)
 
-        if assignment:
-            server_info = {
-                'ip': assignment['ip'],
-                'port': assignment['port'],
-                'connection': assignment['connection']
-            }
-            player_info = {
-                'skill': ticket.search_fields.double_args['skill'],
-                'latency': ticket.search_fields.double_args['latency'],
-                'region': region
-            }
+@app.route('/tickets', methods=['POST'])
+async def post_ticket():
+    """チケットを作成してすぐに返す。結果は /tickets/<id>/events で受け取る"""
+    auth_header = request.headers.get('Authorization')
+    if not check_auth(auth_header):
+        return jsonify({'error': 'Unauthorized'}), 401
 
-            # JWT生成
-            access_token = generate_jwt(ticket_id, server_info, player_info)
+    body = await request.get_json(silent=True) or {}
+    region = body.get('region')
+    if not isinstance(region, str) or not region:
+        return jsonify({'error': 'region is required'}), 400
 
-            result = {
-                'status': 'matched',
-                'ticket_id': ticket_id,
-                'server': server_info,
-                'player': player_info,
-                'jwt': access_token
-            }
-            logger.info(f"Match found for ticket {ticket_id}: {assignment['connection']}")
-            return jsonify(result), 200
-        else:
-            result = {
-                'status': 'timeout',
-                'ticket_id': ticket_id,
-                'message': 'No match found within timeout period'
-            }
-            logger.warning(f"Timeout for ticket {ticket_id}")
-            return jsonify(result), 408
+    if len(dispatcher) >= dispatcher.max_waiting:
+        return jsonify({'error': 'Too many players waiting, retry later'}), 503
+
+    try:
+        key, player_id, proof = idempotency_key()
+        ticket, token, created = await open_ticket(region, key, player_id, proof)
+        # /events は購読トークンを持つ作成者だけが購読できる（EventSource はヘッダを付けられないのでクエリで渡す）
+        return jsonify({
+            'status': 'searching',
+            'ticket_id': ticket.id,
+            'subscription_token': token,
+            'events': f'/tickets/{ticket.id}/events?token={token}'
+        }), 201 if created else 200
 
     except grpc.RpcError as e:
         logger.error(f"gRPC error: {e.code()} - {e.details()}")
@@ -252,6 +832,60 @@ def play(region: str):
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/tickets/<ticket_id>/events', methods=['GET'])
+async def ticket_events(ticket_id: str):
+    """チケットの状態を Server-Sent Events で送る（searching -> matched / timeout）
+
+    POST /tickets が返した購読トークン（?token=）が必要。チケットIDだけでは JWT を受け取れない。
+    ブラウザの EventSource はヘッダを付けられないので、Bearer 認証ではなくこのトークンだけで認可する。
+    """
+    try:
+        ticket = await find_ticket(ticket_id)
+    except grpc.RpcError as e:
+        logger.error(f"gRPC error: {e.code()} - {e.details()}")
+        return jsonify({'error': f'gRPC error: {e.details()}'}), 500
+    # トークン違いも 404 にし、推測したチケットIDの存在を確かめられないようにする
+    if ticket is None or not check_subscription(ticket, request.args.get('token')):
+        return jsonify({'error': 'Ticket not found'}), 404
+    # 購読中は追跡し（再接続なら猶予中の期限を延ばす）、切断されたら猶予後に削除する
+    tickets.add(ticket)
+
+    async def events():
+        yield sse_event('status', {'status': 'searching', 'ticket_id': ticket_id})
+        waiting = asyncio.ensure_future(get_assignment(ticket_id))
+        finished = False
+        try:
+            while True:
+                done, _ = await asyncio.wait({waiting}, timeout=SSE_HEARTBEAT_SECONDS)
+                if done:
+                    break
+                yield b': keepalive\n\n'
+
+            try:
+                assignment = waiting.result()
+            except TooManyWaiters as e:
+                logger.warning(f"Rejecting player: {e}")
+                yield sse_event('error', {'error': 'Too many players waiting, retry later'})
+                return
+            finished = True
+            if assignment:
+                yield sse_event('matched', matched_result(ticket, assignment))
+            else:
+                yield sse_event('timeout', timeout_result(ticket_id))
+        finally:
+            # クライアント切断時は待機を取り消し、DISCONNECT_GRACE の間に再接続が無ければチケットを削除する
+            waiting.cancel()
+            if not finished:
+                tickets.abandon_later(ticket_id, DISCONNECT_GRACE)
+                logger.info(f"Event stream for ticket {ticket_id} closed, abandoning after {DISCONNECT_GRACE}s")
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+
+
 if __name__ == '__main__':
     logger.info("=" * 60)
     logger.info("Game Frontend HTTP API Server")
@@ -269,7 +903,17 @@ if __name__ == '__main__':
     logger.info("Endpoints:")
     logger.info(f"  - GET  /health")
     logger.info(f"  - GET  /play/<region>")
+    logger.info(f"  - POST /tickets")
+    logger.info(f"  - GET  /tickets/<id>/events?token=<subscription_token> (Server-Sent Events)")
     logger.info(f"  - GET  /.well-known/jwks.json (Public Key)")
     logger.info("=" * 60)
 
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f'0.0.0.0:{PORT}']
+    config.accesslog = None
+    # 数千人が同時に接続してくるため listen キューを広げる
+    config.backlog = 2048
+    asyncio.run(serve(app, config))
@@ -1,14 +1,35 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
+import copy
+import itertools
 import logging
+import math
+import multiprocessing
+import operator
+import random
+import signal
 import time
+import threading
+import uuid
 import grpc
+import numpy as np
+from array import array
+from collections import OrderedDict
 from concurrent import futures
+from multiprocessing import shared_memory
+from google.protobuf import json_format
+from google.protobuf import struct_pb2
+from google.protobuf import timestamp_pb2
+from google.protobuf import wrappers_pb2
 import sys
 import os
 
 sys.path.insert(0, os.path.dirname(__file__))
 
+from protos.api import frontend_pb2
+from protos.api import frontend_pb2_grpc
 from protos.api import matchfunction_pb2
 from protos.api import matchfunction_pb2_grpc
 from protos.api import messages_pb2
@@ -23,27 +44,1624 @@ logger = logging.getLogger(__name__)
 
 QUERY_SERVICE_HOST = os.getenv('OPEN_MATCH_QUERY_SERVICE', 'open-match-query.open-match.svc.cluster.local')
 QUERY_SERVICE_PORT = os.getenv('OPEN_MATCH_QUERY_SERVICE_PORT', '50503')
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', '10'))
+# キャッシュ未登録チケットの個別取得に使う
+FRONTEND_SERVICE = os.getenv(
+    'OPEN_MATCH_FRONTEND_SERVICE',
+    'open-match-frontend.open-match.svc.cluster.local:50504'
+)
+
+# チケットキャッシュ設定
+TICKET_CACHE_ENABLED = os.getenv('TICKET_CACHE_ENABLED', 'true').lower() == 'true'
+TICKET_CACHE_TTL = float(os.getenv('TICKET_CACHE_TTL', '300'))
+TICKET_CACHE_MAX_SIZE = int(os.getenv('TICKET_CACHE_MAX_SIZE', '100000'))
+TICKET_CACHE_MAX_POOLS = int(os.getenv('TICKET_CACHE_MAX_POOLS', '32'))
+# 新規IDの割合がこれを超えたら個別取得せずQueryTicketsで取り直す
+TICKET_CACHE_REFILL_RATIO = float(os.getenv('TICKET_CACHE_REFILL_RATIO', '0.1'))
+# 個別取得で同時に発行する GetTicket の上限
+GET_TICKET_CONCURRENCY = int(os.getenv('GET_TICKET_CONCURRENCY', '32'))
+
+# ストリーミングモード: ページ到着ごとにウィンドウ単位でマッチングする
+# （skill-pairs 戦略のプロファイルのみ。他の戦略は全件を問い合わせる通常の Run になる）
+MATCH_STREAMING = os.getenv('MATCH_STREAMING', 'false').lower() == 'true'
+MATCH_WINDOW_SIZE = int(os.getenv('MATCH_WINDOW_SIZE', '1000'))
+MATCH_SIZE = 2
+
+# 1回の Run で同時に問い合わせるプール数
+POOL_QUERY_WORKERS = int(os.getenv('POOL_QUERY_WORKERS', '8'))
+# 品質スコアをまとめて計算する提案数（--aio では executor から1回に受け取る提案数も兼ねる）
+MATCH_CHUNK_SIZE = int(os.getenv('MATCH_CHUNK_SIZE', '1000'))
+
+# パーティション並列マッチング（0 で無効）
+# MATCH_PARTITION_KEYS: string_args 名、または double_args 名:帯幅（例: region,mode,skill:0.5）
+MATCH_PROCESSES = int(os.getenv('MATCH_PROCESSES', '0'))
+MATCH_PARTITION_KEYS = os.getenv('MATCH_PARTITION_KEYS', 'region')
+# これ未満のチケット数ならプロセスを使わずその場でマッチングする
+MATCH_PARALLEL_MIN_TICKETS = int(os.getenv('MATCH_PARALLEL_MIN_TICKETS', '2000'))
+
+# 1回の Run でプールごとに扱うチケット数の上限（0 で無制限）
+# 超過時: oldest = created_before で区切った古い時間帯から順に取得, sample = 一様サンプリング
+MAX_TICKETS_PER_POOL = int(os.getenv('MAX_TICKETS_PER_POOL', '0'))
+QUERY_OVERFLOW_POLICY = os.getenv('QUERY_OVERFLOW_POLICY', 'oldest')
+QUERY_SLICE_SECONDS = int(os.getenv('QUERY_SLICE_SECONDS', '60'))
+QUERY_SLICE_HORIZON = int(os.getenv('QUERY_SLICE_HORIZON', '600'))
+
+# 再戦回避・ブロックリスト
+# プレイヤーIDは string_args[PLAYER_ID_ARG]、ブロック相手は string_args[BLOCKED_PLAYERS_ARG]（カンマ区切り）
+# 提案したマッチは、全チケットが同じ接続先にアサインされたのを GetTicket で確かめてから記録する
+# REMATCH_CONFIRM_SECONDS 経ってもアサインされない提案は捨てる
+REMATCH_AVOIDANCE = os.getenv('REMATCH_AVOIDANCE', 'false').lower() == 'true'
+REMATCH_TTL = float(os.getenv('REMATCH_TTL', '1800'))
+REMATCH_HISTORY = int(os.getenv('REMATCH_HISTORY', '20'))
+REMATCH_MAX_PLAYERS = int(os.getenv('REMATCH_MAX_PLAYERS', '100000'))
+REMATCH_CONFIRM_SECONDS = float(os.getenv('REMATCH_CONFIRM_SECONDS', '90'))
+REMATCH_LOOKAHEAD = int(os.getenv('REMATCH_LOOKAHEAD', '8'))
+PLAYER_ID_ARG = os.getenv('PLAYER_ID_ARG', 'player_id')
+BLOCKED_PLAYERS_ARG = os.getenv('BLOCKED_PLAYERS_ARG', 'blocked_players')
+
+# 提案ごとの品質スコア（Match.extensions['quality'] に DoubleValue で付与）
+# penalty = スキル差 * QUALITY_SKILL_WEIGHT + レイテンシ差(ms) * QUALITY_LATENCY_WEIGHT を
+# 平均待ち秒 * QUALITY_WAIT_WEIGHT で緩和し、1 / (1 + penalty) を 0〜1 のスコアとする
+QUALITY_SKILL_WEIGHT = float(os.getenv('QUALITY_SKILL_WEIGHT', '5.0'))
+QUALITY_LATENCY_WEIGHT = float(os.getenv('QUALITY_LATENCY_WEIGHT', '0.02'))
+QUALITY_WAIT_WEIGHT = float(os.getenv('QUALITY_WAIT_WEIGHT', '0.05'))
+QUALITY_BUCKETS = 10
+
+# 設定すると各 Run のプロファイルと取得チケットをこのファイルに追記する（オフライン再生用）
+MATCH_CAPTURE_PATH = os.getenv('MATCH_CAPTURE_PATH', '')
+
+# マッチング戦略の選択
+# プロファイルの extensions['strategy'] (StringValue) > MATCH_STRATEGY_BY_PROFILE (profile=strategy,...)
+# > プロファイル名と同名の戦略 > DEFAULT_MATCH_STRATEGY の順
+DEFAULT_MATCH_STRATEGY = os.getenv(
+    'DEFAULT_MATCH_STRATEGY',
+    'skill-pairs' if MATCH_STREAMING else 'partitioned' if MATCH_PROCESSES > 0 else 'first-pair'
+)
+MATCH_STRATEGY_BY_PROFILE = os.getenv('MATCH_STRATEGY_BY_PROFILE', '')
+STRATEGY_CACHE_SIZE = int(os.getenv('STRATEGY_CACHE_SIZE', '64'))
+
+# 複数プールを共通フィルタの1クエリにまとめ、プールへの振り分けはローカルで行う
+LOCAL_POOL_FILTERING = os.getenv('LOCAL_POOL_FILTERING', 'false').lower() == 'true'
+
+
+def new_match_id():
+    return f"match-{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+
+def make_match(profile, tickets, backfill=None):
+    return messages_pb2.Match(
+        match_id=new_match_id(),
+        match_profile=profile.name,
+        match_function="matchfunction",
+        tickets=tickets,
+        backfill=backfill
+    )
+
+
+class TicketCache:
+    """プール単位のチケットキャッシュ（チケットID -> Ticket, TTL + LRU）"""
+
+    def __init__(self, ttl=TICKET_CACHE_TTL, max_size=TICKET_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def sync(self, live_ids, evict=True):
+        """プールから消えたIDを破棄し、取得が必要なIDを返す
+
+        evict=False はプールの一部（時間帯）だけを見ている場合で、他のIDは TTL / LRU に任せる。
+        """
+        now = time.monotonic()
+        with self._lock:
+            if evict:
+                for ticket_id in self._entries.keys() - set(live_ids):
+                    del self._entries[ticket_id]
+
+            missing = []
+            for ticket_id in live_ids:
+                entry = self._entries.get(ticket_id)
+                if entry is None or entry[1] <= now:
+                    missing.append(ticket_id)
+            return missing
+
+    def put(self, tickets):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for ticket in tickets:
+                self._entries[ticket.id] = (ticket, expires_at)
+                self._entries.move_to_end(ticket.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_many(self, ticket_ids):
+        tickets = []
+        with self._lock:
+            for ticket_id in ticket_ids:
+                entry = self._entries.get(ticket_id)
+                if entry is not None:
+                    self._entries.move_to_end(ticket_id)
+                    tickets.append(entry[0])
+        return tickets
+
+
+class TicketBatch:
+    """マッチング用の列指向チケットバッチ（Run ごとに一度だけ構築）
+
+    - ids: sys.intern 済みのチケットID
+    - create_time_ns: 作成時刻（ナノ秒, 欠損行は has_create_time のビットが立たない）
+    - doubles: double_args 名 -> array('d')（欠損は NaN）
+    - strings: string_args 名 -> array('i') の辞書コード（欠損は -1）、値は string_values
+    - tags: タグ -> 行ビットセット（int）
+    - pool_rows: プール名 -> 行番号 array('i')
+    - backfills: 戦略が必要とする場合のみ QueryBackfills の結果
+    - opponents: 再戦回避が有効な場合の OpponentFilter
+    """
+
+    def __init__(self, tickets, pool_rows=None):
+        n = len(tickets)
+        self._tickets = tickets
+        self.ids = [sys.intern(ticket.id) for ticket in tickets]
+        self.create_time_ns = array('q', bytes(8 * n))
+        self.has_create_time = 0
+        self.doubles = {}
+        self.strings = {}
+        self.string_values = {}
+        self._string_codes = {}
+        self.tags = {}
+        self.pool_rows = pool_rows if pool_rows is not None else OrderedDict()
+        self.backfills = []
+        # 再戦回避が有効な場合の OpponentFilter（戦略は compatible(row_a, row_b) で参照する）
+        self.opponents = None
+        self._row_of = None
+
+        nan = math.nan
+        for row, ticket in enumerate(tickets):
+            bit = 1 << row
+            if ticket.HasField('create_time'):
+                self.create_time_ns[row] = ticket.create_time.ToNanoseconds()
+                self.has_create_time |= bit
+            fields = ticket.search_fields
+            for name, value in fields.double_args.items():
+                column = self.doubles.get(name)
+                if column is None:
+                    column = self.doubles[name] = array('d', [nan]) * n
+                column[row] = value
+            for name, value in fields.string_args.items():
+                column = self.strings.get(name)
+                if column is None:
+                    column = self.strings[name] = array('i', [-1]) * n
+                    self.string_values[name] = []
+                    self._string_codes[name] = {}
+                codes = self._string_codes[name]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(self.string_values[name])
+                    self.string_values[name].append(value)
+                column[row] = code
+            for tag in fields.tags:
+                self.tags[tag] = self.tags.get(tag, 0) | bit
+
+    @classmethod
+    def from_pools(cls, pool_tickets):
+        """プール名 -> チケット一覧 から構築（プール間の重複チケットは1行にまとめる）"""
+        tickets = []
+        row_of = {}
+        pool_rows = OrderedDict()
+        for name, pool in pool_tickets.items():
+            rows = array('i')
+            for ticket in pool:
+                row = row_of.get(ticket.id)
+                if row is None:
+                    row = row_of[ticket.id] = len(tickets)
+                    tickets.append(ticket)
+                rows.append(row)
+            pool_rows[name] = rows
+        return cls(tickets, pool_rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def pooled_rows(self):
+        """いずれかのプールに属する行（プール順, 重複なし）"""
+        seen = set()
+        rows = array('i')
+        for pool in self.pool_rows.values():
+            for row in pool:
+                if row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+        return rows
+
+    def restrict(self, rows, name='restricted'):
+        """列を共有したまま、指定行だけを1プールとして持つバッチを返す"""
+        view = copy.copy(self)
+        view.pool_rows = OrderedDict([(name, array('i', rows))])
+        return view
+
+    def double(self, name):
+        column = self.doubles.get(name)
+        if column is None:
+            column = self.doubles[name] = array('d', [math.nan]) * len(self)
+        return column
+
+    def string_code(self, name, value):
+        return self._string_codes.get(name, {}).get(value, -1)
+
+    def tag_rows(self, tag):
+        return self.tags.get(tag, 0)
+
+    def has_tag(self, row, tag):
+        return (self.tags.get(tag, 0) >> row) & 1 == 1
+
+    def ticket(self, row):
+        return self._tickets[row]
+
+    def rows_of(self, ticket_ids):
+        if self._row_of is None:
+            self._row_of = {ticket_id: row for row, ticket_id in enumerate(self.ids)}
+        return [self._row_of[ticket_id] for ticket_id in ticket_ids]
+
+    def tickets(self, rows):
+        return [self._tickets[row] for row in rows]
+
+
+class QualityScorer:
+    """TicketBatch の列から提案の品質スコアを計算し、Match.extensions['quality'] に付与する
+
+    待ち時間が長いチケットほど同じスキル差・レイテンシ差でも高く評価する。
+    histogram は Run 単位のスコア分布（QUALITY_BUCKETS 等分）。
+    """
+
+    def __init__(self, batch, histogram=None, now_ns=None):
+        self.batch = batch
+        self.histogram = histogram if histogram is not None else [0] * QUALITY_BUCKETS
+        self.now_ns = time.time_ns() if now_ns is None else now_ns
+        n = len(batch)
+        # 列を numpy で参照する（array はコピーせずにバッファを共有）
+        self._skill = np.frombuffer(batch.double('skill'), dtype=np.float64, count=n)
+        self._latency = np.frombuffer(batch.double('latency'), dtype=np.float64, count=n)
+        self._waited = None
+        self._timed = None
+
+    def _wait_columns(self):
+        if self._waited is None:
+            n = len(self.batch)
+            bits = self.batch.has_create_time.to_bytes((n + 7) // 8, 'little')
+            self._timed = np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=n, bitorder='little').astype(bool)
+            created = np.frombuffer(self.batch.create_time_ns, dtype=np.int64, count=n)
+            self._waited = np.where(self._timed, (self.now_ns - created) / 1e9, 0.0)
+        return self._waited, self._timed
+
+    def scores(self, rows, offsets):
+        """グループ i = rows[offsets[i]:offsets[i + 1]] ごとのスコアを1回の配列演算で求める"""
+        scores = np.ones(len(offsets) - 1)
+        nonempty = np.diff(offsets) > 0
+        if not nonempty.any():
+            return scores
+        starts = offsets[:-1][nonempty]
+        waited, timed = self._wait_columns()
+
+        penalty = np.zeros(len(starts))
+        with np.errstate(invalid='ignore'):
+            # fmax / fmin は NaN（欠損）を無視する。全員欠損のグループは NaN になり 0 として扱う
+            for column, weight in ((self._skill, QUALITY_SKILL_WEIGHT), (self._latency, QUALITY_LATENCY_WEIGHT)):
+                values = column[rows]
+                spread = np.fmax.reduceat(values, starts) - np.fmin.reduceat(values, starts)
+                penalty += weight * np.nan_to_num(spread)
+        counts = np.add.reduceat(timed[rows].astype(np.int64), starts)
+        mean_wait = np.add.reduceat(waited[rows], starts) / np.maximum(counts, 1)
+        penalty = np.where(counts > 0, penalty / (1.0 + QUALITY_WAIT_WEIGHT * np.maximum(mean_wait, 0.0)), penalty)
+        scores[nonempty] = 1.0 / (1.0 + penalty)
+        return scores
+
+    def attach_all(self, matches):
+        """提案のスコアをまとめて計算して付与し、スコアの配列を返す"""
+        ids = [ticket.id for match in matches for ticket in match.tickets]
+        rows = np.array(self.batch.rows_of(ids), dtype=np.int64)
+        offsets = np.zeros(len(matches) + 1, dtype=np.int64)
+        np.cumsum([len(match.tickets) for match in matches], out=offsets[1:])
+        qualities = self.scores(rows, offsets)
+        for match, quality in zip(matches, qualities.tolist()):
+            match.extensions['quality'].Pack(wrappers_pb2.DoubleValue(value=quality))
+        buckets = np.minimum((qualities * QUALITY_BUCKETS).astype(np.int64), QUALITY_BUCKETS - 1)
+        for bucket, count in enumerate(np.bincount(buckets, minlength=QUALITY_BUCKETS).tolist()):
+            self.histogram[bucket] += count
+        return qualities
+
+    def attach(self, match):
+        return float(self.attach_all([match])[0])
+
+
+def format_quality_histogram(histogram):
+    width = 1.0 / len(histogram)
+    return ' '.join(f"{i * width:.1f}-{(i + 1) * width:.1f}:{count}" for i, count in enumerate(histogram))
+
+
+def pair_by_skill(skill, rows, size=MATCH_SIZE, compatible=None):
+    """行をスキル順に並べて size 人ずつまとめる。(グループ一覧, 余りの行) を返す
+
+    compatible(row_a, row_b) を渡すと、グループ内の全組が両立するように
+    スキル順で後続 REMATCH_LOOKAHEAD 件までの候補から相手を選ぶ。
+    """
+    ordered = sorted(rows, key=lambda row: 0.0 if math.isnan(skill[row]) else skill[row])
+    if compatible is None:
+        matched = len(ordered) - len(ordered) % size
+        groups = [tuple(ordered[i:i + size]) for i in range(0, matched, size)]
+        return groups, ordered[matched:]
+
+    groups = []
+    used = set()
+    for i, row in enumerate(ordered):
+        if row in used:
+            continue
+        group = [row]
+        looked = 0
+        j = i + 1
+        while len(group) < size and j < len(ordered) and looked < REMATCH_LOOKAHEAD:
+            candidate = ordered[j]
+            j += 1
+            if candidate in used:
+                continue
+            looked += 1
+            if all(compatible(candidate, member) for member in group):
+                group.append(candidate)
+        if len(group) == size:
+            used.update(group)
+            groups.append(tuple(group))
+    return groups, [row for row in ordered if row not in used]
+
+
+def _pair_partition_shared(shm_name, n, start, stop, size=MATCH_SIZE):
+    """ワーカープロセス側: 共有メモリ上のスキル列と行番号を読んでペアを作る"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    skill = shm.buf[:8 * n].cast('d')
+    rows = shm.buf[8 * n:].cast('i')
+    try:
+        groups, _ = pair_by_skill(skill, rows[start:stop], size)
+        return groups
+    finally:
+        skill.release()
+        rows.release()
+        shm.close()
+
+
+class RecentOpponents:
+    """プレイヤーごとの直近の対戦相手（相手ごとの最終対戦時刻, 件数上限つき）
+
+    recently_played は dict 参照2回で判定できる。古い記録は REMATCH_TTL で無効になり、
+    プレイヤー数・1人あたりの相手数を超えた分は古いものから捨てる。
+    """
+
+    def __init__(self, ttl=REMATCH_TTL, per_player=REMATCH_HISTORY, max_players=REMATCH_MAX_PLAYERS):
+        self.ttl = ttl
+        self.per_player = per_player
+        self.max_players = max_players
+        self._players = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._players)
+
+    def record(self, players, now=None):
+        """同じマッチに入ったプレイヤー同士を対戦済みとして記録する"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for player in players:
+                opponents = self._players.get(player)
+                if opponents is None:
+                    opponents = self._players[player] = OrderedDict()
+                else:
+                    self._players.move_to_end(player)
+                for opponent in players:
+                    if opponent != player:
+                        opponents[opponent] = now
+                        opponents.move_to_end(opponent)
+                while len(opponents) > self.per_player:
+                    opponents.popitem(last=False)
+            while len(self._players) > self.max_players:
+                self._players.popitem(last=False)
+
+    def recently_played(self, player, opponent, now=None):
+        opponents = self._players.get(player)
+        if opponents is None:
+            return False
+        played_at = opponents.get(opponent)
+        if played_at is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - played_at < self.ttl
+
+
+class OpponentFilter:
+    """Run 内で行同士が対戦可能かを O(1) で判定する（同一プレイヤー・ブロック・直近の対戦相手）"""
+
+    def __init__(self, batch, recent, player_arg=PLAYER_ID_ARG, blocked_arg=BLOCKED_PLAYERS_ARG):
+        self.recent = recent
+        self.now = time.monotonic()
+
+        players = batch.strings.get(player_arg)
+        values = batch.string_values.get(player_arg)
+        self.players = [None if code < 0 else values[code] for code in players] if players is not None \
+            else [None] * len(batch)
+
+        # ブロックリストは辞書コードごとに一度だけ集合にする
+        self._blocked = batch.strings.get(blocked_arg)
+        self._blocked_sets = [
+            frozenset(p.strip() for p in value.split(',') if p.strip())
+            for value in batch.string_values.get(blocked_arg, [])
+        ]
+
+    def blocked(self, row):
+        if self._blocked is None or self._blocked[row] < 0:
+            return frozenset()
+        return self._blocked_sets[self._blocked[row]]
+
+    def compatible(self, a, b):
+        player_a = self.players[a]
+        player_b = self.players[b]
+        if player_a is None or player_b is None:
+            return True
+        if player_a == player_b:
+            return False
+        if player_b in self.blocked(a) or player_a in self.blocked(b):
+            return False
+        return not self.recent.recently_played(player_a, player_b, self.now)
+
+
+def parse_partition_keys(spec):
+    keys = []
+    for item in spec.split(','):
+        name, _, width = item.strip().partition(':')
+        if name:
+            keys.append((name, float(width) if width else None))
+    return keys
+
+
+def partition_rows(batch, rows, keys):
+    """キー（文字列引数 / double 引数の帯）ごとに行を分割する"""
+    columns = []
+    for name, width in keys:
+        if width is None:
+            columns.append((batch.strings.get(name), None))
+        else:
+            columns.append((batch.double(name), width))
+
+    partitions = {}
+    for row in rows:
+        key = []
+        for column, width in columns:
+            if column is None:
+                key.append(-1)
+            elif width is None:
+                key.append(column[row])
+            else:
+                value = column[row]
+                key.append(None if math.isnan(value) else math.floor(value / width))
+        partitions.setdefault(tuple(key), array('i')).append(row)
+    return partitions
+
+
+_BIT_CHARS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def flags_to_bitset(flags):
+    """行ごとの 0/1 フラグ（bytes）を行ビットセットに変換"""
+    if not flags:
+        return 0
+    return int(bytes(flags).translate(_BIT_CHARS)[::-1], 2)
+
+
+def bitset_rows(bits):
+    """行ビットセットを昇順の行番号 array('i') に変換"""
+    rows = array('i')
+    digits = format(bits, 'b')[::-1] if bits else ''
+    row = digits.find('1')
+    while row >= 0:
+        rows.append(row)
+        row = digits.find('1', row + 1)
+    return rows
+
+
+# DoubleRangeFilter.Exclude -> (下限の比較, 上限の比較)
+_RANGE_COMPARATORS = {
+    messages_pb2.DoubleRangeFilter.NONE: (operator.ge, operator.le),
+    messages_pb2.DoubleRangeFilter.MIN: (operator.gt, operator.le),
+    messages_pb2.DoubleRangeFilter.MAX: (operator.ge, operator.lt),
+    messages_pb2.DoubleRangeFilter.BOTH: (operator.gt, operator.lt),
+}
+
+
+class PoolFilter:
+    """messages_pb2.Pool のフィルタを Open Match と同じ意味でローカル評価する
+
+    - DoubleRangeFilter: 引数が無い・NaN のチケットは除外、Exclude で境界を開区間にする
+    - StringEqualsFilter: 引数が無いチケットは除外
+    - TagPresentFilter: タグを全て持つこと
+    - created_after / created_before: 設定されたものだけを排他的に適用
+      （create_time の無いチケットには適用しない）
+    """
+
+    def __init__(self, pool):
+        self.name = pool.name
+        self.double_ranges = [
+            (f.double_arg, f.min, f.max) + _RANGE_COMPARATORS[f.exclude]
+            for f in pool.double_range_filters
+        ]
+        self.string_equals = [(f.string_arg, f.value) for f in pool.string_equals_filters]
+        self.tags = [f.tag for f in pool.tag_present_filters]
+        self.created_after = pool.created_after.ToNanoseconds() if pool.HasField('created_after') else None
+        self.created_before = pool.created_before.ToNanoseconds() if pool.HasField('created_before') else None
+
+    def matches(self, ticket):
+        """チケット1件の判定（リファレンス実装）"""
+        if ticket.HasField('create_time'):
+            created = ticket.create_time.ToNanoseconds()
+            if self.created_after is not None and not created > self.created_after:
+                return False
+            if self.created_before is not None and not created < self.created_before:
+                return False
+
+        fields = ticket.search_fields
+        for name, low, high, above, below in self.double_ranges:
+            if name not in fields.double_args:
+                return False
+            value = fields.double_args[name]
+            if not (above(value, low) and below(value, high)):
+                return False
+        for name, value in self.string_equals:
+            if fields.string_args.get(name) != value:
+                return False
+        tags = fields.tags
+        return all(tag in tags for tag in self.tags)
+
+    def evaluate(self, batch):
+        """TicketBatch 全行を列単位で評価し、条件を満たす行のビットセットを返す"""
+        n = len(batch)
+        bits = (1 << n) - 1
+
+        for tag in self.tags:
+            bits &= batch.tag_rows(tag)
+            if not bits:
+                return 0
+
+        for name, value in self.string_equals:
+            code = batch.string_code(name, value)
+            if code < 0:
+                return 0
+            bits &= flags_to_bitset(bytes(c == code for c in batch.strings[name]))
+            if not bits:
+                return 0
+
+        for name, low, high, above, below in self.double_ranges:
+            column = batch.doubles.get(name)
+            if column is None:
+                return 0
+            # NaN（欠損）はどちらの比較も False になり除外される
+            bits &= flags_to_bitset(bytes(above(v, low) and below(v, high) for v in column))
+            if not bits:
+                return 0
+
+        if self.created_after is not None or self.created_before is not None:
+            after = self.created_after
+            before = self.created_before
+            in_window = flags_to_bitset(bytes(
+                (after is None or t > after) and (before is None or t < before)
+                for t in batch.create_time_ns
+            ))
+            bits &= in_window | (~batch.has_create_time & ((1 << n) - 1))
+
+        return bits
+
+
+def pool_window(pool):
+    """プールの (created_after, created_before) をナノ秒で返す（未設定は None）"""
+    return (
+        pool.created_after.ToNanoseconds() if pool.HasField('created_after') else None,
+        pool.created_before.ToNanoseconds() if pool.HasField('created_before') else None,
+    )
+
+
+def with_window(pool, after, before):
+    """created_after / created_before だけを置き換えたプールを返す（None は未設定）"""
+    sub = messages_pb2.Pool()
+    sub.CopyFrom(pool)
+    sub.ClearField('created_after')
+    sub.ClearField('created_before')
+    if after is not None:
+        sub.created_after.FromNanoseconds(after)
+    if before is not None:
+        sub.created_before.FromNanoseconds(before)
+    return sub
+
+
+def time_slices(pool, now_ns, slice_seconds=QUERY_SLICE_SECONDS, horizon_seconds=QUERY_SLICE_HORIZON):
+    """プールを作成時刻の古い順の時間帯に分割したサブプールを返す
+
+    区切りは slice_seconds の倍数に揃える。先頭は horizon より古い全チケット（下限なし）、
+    末尾は時計ずれに備えて上限なし。多すぎる時間帯は bisect_slice でさらに分ける。
+    """
+    step = slice_seconds * 10**9
+    end = (now_ns // step + 1) * step
+    start = end - max(1, math.ceil(horizon_seconds / slice_seconds)) * step
+    bounds = [None] + list(range(start, end + 1, step)) + [None]
+
+    pool_after, pool_before = pool_window(pool)
+
+    slices = []
+    for low, high in zip(bounds, bounds[1:]):
+        # 時間帯 [low, high) を排他的な created_after / created_before で表す
+        after = None if low is None else low - 1
+        if pool_after is not None:
+            after = pool_after if after is None else max(after, pool_after)
+        before = high
+        if pool_before is not None:
+            before = pool_before if before is None else min(before, pool_before)
+        if after is not None and before is not None and after + 1 >= before:
+            continue
+        slices.append(with_window(pool, after, before))
+    return slices
+
+
+def bisect_slice(sub, now_ns, min_seconds=1):
+    """時間帯を (古い側, 新しい側) に分ける。これ以上分けられなければ None
+
+    下限のない時間帯は上限から「現在までの経過時間」だけ遡った点で分け、
+    古いバックログほど少ない回数で区切れるようにする。上限のない時間帯と
+    min_seconds 以下の時間帯は分けない。
+    """
+    after, before = pool_window(sub)
+    if before is None:
+        return None
+    if after is None:
+        split = before - max(now_ns - before, QUERY_SLICE_SECONDS * 10**9)
+        if split <= 0:
+            return None
+    else:
+        width = before - (after + 1)
+        if width <= min_seconds * 10**9:
+            return None
+        split = after + 1 + width // 2
+    return with_window(sub, after, split), with_window(sub, split - 1, before)
+
+
+def ticket_in_pool(ticket, pool):
+    return PoolFilter(pool).matches(ticket)
+
+
+def superset_pool(pools):
+    """全プールに共通するフィルタだけを持つプール（各プールの上位集合）を返す"""
+    first, rest = pools[0], pools[1:]
+
+    def common(field):
+        return [f for f in getattr(first, field) if all(f in getattr(pool, field) for pool in rest)]
+
+    superset = messages_pb2.Pool(
+        name='superset',
+        double_range_filters=common('double_range_filters'),
+        string_equals_filters=common('string_equals_filters'),
+        tag_present_filters=common('tag_present_filters'),
+    )
+    if all(pool.HasField('created_after') for pool in pools):
+        superset.created_after.CopyFrom(min(pools, key=lambda p: p.created_after.ToNanoseconds()).created_after)
+    if all(pool.HasField('created_before') for pool in pools):
+        superset.created_before.CopyFrom(max(pools, key=lambda p: p.created_before.ToNanoseconds()).created_before)
+    return superset
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    """パーティション並列用のプロセスプール（gRPC を読み込んだプロセスの fork を避けるため spawn）"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = futures.ProcessPoolExecutor(
+                max_workers=max(1, MATCH_PROCESSES), mp_context=multiprocessing.get_context('spawn')
+            )
+            logger.info(f"Started match process pool ({max(1, MATCH_PROCESSES)} processes)")
+        return _process_pool
+
+
+STRATEGIES = {}
+
+
+def register_strategy(name):
+    def decorator(cls):
+        cls.name = name
+        STRATEGIES[name] = cls
+        return cls
+    return decorator
+
+
+class MatchStrategy:
+    """マッチング戦略の基底クラス
+
+    インスタンスは (戦略名, 設定) ごとに1つだけ作られ、Run をまたいで再利用される。
+    設定は compile_config で一度だけ解釈する。複数の Run から同時に呼ばれるため、
+    match で共有状態を書き換える場合は戦略側でロックすること。
+    """
+
+    name = None
+    # True の場合、Run は各プールの QueryBackfills 結果を batch.backfills に入れる
+    uses_backfills = False
+
+    def __init__(self, config):
+        self.config = self.compile_config(config)
+
+    @classmethod
+    def compile_config(cls, config):
+        return config
+
+    def match(self, profile, batch):
+        """TicketBatch からマッチ提案（messages_pb2.Match）を順に返す"""
+        raise NotImplementedError
+
+
+@register_strategy('first-pair')
+class FirstPairStrategy(MatchStrategy):
+    """プール順で先頭の2チケットを1組だけマッチさせる"""
+
+    def match(self, profile, batch):
+        rows = batch.pooled_rows()
+        if batch.opponents is not None and len(rows) >= 2:
+            # 先頭チケットと対戦可能な最初の相手を選ぶ
+            first = rows[0]
+            rows = [first] + [row for row in rows[1:] if batch.opponents.compatible(first, row)][:1]
+        if len(rows) >= 2:
+            match = make_match(profile, batch.tickets(rows[:2]))
+            logger.info(f"Created match {match.match_id} with tickets: {batch.ids[rows[0]]}, {batch.ids[rows[1]]}")
+            yield match
+        else:
+            logger.info("Not enough tickets for a 2-player match")
+
+
+@register_strategy('skill-pairs')
+class SkillPairsStrategy(MatchStrategy):
+    """全チケットをスキル順に並べて size 人ずつまとめる"""
+
+    @classmethod
+    def compile_config(cls, config):
+        return {'size': int(config.get('size', MATCH_SIZE))}
+
+    def match(self, profile, batch):
+        compatible = batch.opponents.compatible if batch.opponents is not None else None
+        groups, _ = pair_by_skill(batch.double('skill'), batch.pooled_rows(), self.config['size'], compatible)
+        for group in groups:
+            yield make_match(profile, batch.tickets(group))
+
+
+@register_strategy('partitioned')
+class PartitionedStrategy(MatchStrategy):
+    """キーでパーティションに分け、各パーティションをプロセスプールでスキル順にまとめる"""
+
+    @classmethod
+    def compile_config(cls, config):
+        return {
+            'keys': parse_partition_keys(config.get('keys', MATCH_PARTITION_KEYS)),
+            'size': int(config.get('size', MATCH_SIZE)),
+            'min_parallel': int(config.get('min_parallel', MATCH_PARALLEL_MIN_TICKETS)),
+        }
+
+    def match(self, profile, batch):
+        """パーティションごとにスキル順ペアリングを行い、完了した順にマッチを返す"""
+        size = self.config['size']
+        partitions = partition_rows(batch, batch.pooled_rows(), self.config['keys'])
+        skill = batch.double('skill')
+        compatible = batch.opponents.compatible if batch.opponents is not None else None
+        logger.info(f"Matching {len(batch)} tickets in {len(partitions)} partitions")
+
+        if len(batch) < self.config['min_parallel']:
+            for rows in partitions.values():
+                groups, _ = pair_by_skill(skill, rows, size, compatible)
+                for group in groups:
+                    yield make_match(profile, batch.tickets(group))
+            return
+
+        # スキル列と行番号を共有メモリに置き、ワーカーには位置だけを渡す
+        pool = get_process_pool()
+        n = len(skill)
+        total_rows = sum(len(rows) for rows in partitions.values())
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 8 * n + 4 * total_rows))
+        try:
+            shm.buf[:8 * n] = skill.tobytes()
+            tasks = []
+            offset = 8 * n
+            start = 0
+            for rows in partitions.values():
+                shm.buf[offset:offset + 4 * len(rows)] = rows.tobytes()
+                offset += 4 * len(rows)
+                tasks.append(pool.submit(
+                    _pair_partition_shared, shm.name, n, start, start + len(rows), size
+                ))
+                start += len(rows)
+
+            for task in futures.as_completed(tasks):
+                groups = task.result()
+                if compatible is not None:
+                    # ワーカーは対戦可否を知らないので、両立しない組の行だけをその場で組み直す
+                    rejected = [
+                        row for group in groups
+                        if not all(compatible(a, b) for i, a in enumerate(group) for b in group[i + 1:])
+                        for row in group
+                    ]
+                    if rejected:
+                        rejected_rows = set(rejected)
+                        groups = [group for group in groups if group[0] not in rejected_rows]
+                        groups += pair_by_skill(skill, rejected, size, compatible)[0]
+                for group in groups:
+                    yield make_match(profile, batch.tickets(group))
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+@register_strategy('backfill')
+class BackfillStrategy(MatchStrategy):
+    """空きのある Backfill を先に埋め、残りのチケットで新規マッチを作る
+
+    Backfill の空き枠数は search_fields.double_args[slots_arg] に持たせる。
+    Backfill は keys の string_args の値でインデックスし、チケットは同じ値の Backfill だけを探す。
+    generation は読み取った値のまま返す（Open Match が保存済みの値と比較し、一致した場合に
+    自身でインクリメントする。ここで増やすと提案は競合として破棄される）。
+    """
+
+    uses_backfills = True
+
+    @classmethod
+    def compile_config(cls, config):
+        then = config.get('then', 'skill-pairs')
+        if then not in STRATEGIES or then == 'backfill':
+            raise ValueError(f"Invalid fallback strategy '{then}' for backfill")
+        keys = config.get('keys', ['region'])
+        return {
+            'keys': [keys] if isinstance(keys, str) else list(keys),
+            'slots_arg': config.get('slots_arg', 'open_slots'),
+            'then': STRATEGIES[then](config.get('then_config', {})),
+        }
+
+    def _index_backfills(self, backfills):
+        index = {}
+        for backfill in backfills:
+            slots = int(backfill.search_fields.double_args.get(self.config['slots_arg'], 0))
+            if slots <= 0:
+                continue
+            key = tuple(backfill.search_fields.string_args.get(name) for name in self.config['keys'])
+            index.setdefault(key, []).append([backfill, slots, []])
+        return index
+
+    def match(self, profile, batch):
+        index = self._index_backfills(batch.backfills)
+        columns = [(batch.strings.get(name), batch.string_values.get(name)) for name in self.config['keys']]
+        compatible = batch.opponents.compatible if batch.opponents is not None else None
+
+        remaining = array('i')
+        filled = []
+        for row in batch.pooled_rows():
+            key = tuple(
+                None if column is None or column[row] < 0 else values[column[row]]
+                for column, values in columns
+            )
+            candidates = index.get(key)
+            # 同じ Backfill に今回入れる他のチケットと対戦可能な、最後尾から最初の Backfill
+            i = len(candidates) - 1 if candidates else -1
+            if compatible is not None:
+                while i >= 0 and not all(compatible(row, other) for other in candidates[i][2]):
+                    i -= 1
+            if i < 0:
+                remaining.append(row)
+                continue
+            entry = candidates[i]
+            if not entry[2]:
+                filled.append(entry)
+            entry[2].append(row)
+            entry[1] -= 1
+            if entry[1] == 0:
+                del candidates[i]
+
+        for original, slots, rows in filled:
+            backfill = messages_pb2.Backfill()
+            backfill.CopyFrom(original)
+            backfill.search_fields.double_args[self.config['slots_arg']] = slots
+            logger.info(f"Filling backfill {backfill.id} (generation {backfill.generation}) "
+                        f"with {len(rows)} tickets, {slots} slots left")
+            yield make_match(profile, batch.tickets(rows), backfill=backfill)
+
+        logger.info(f"Backfilled {sum(len(rows) for _, _, rows in filled)} tickets into {len(filled)} backfills, "
+                    f"{len(remaining)} tickets left for '{self.config['then'].name}'")
+        yield from self.config['then'].match(profile, batch.restrict(remaining))
+
+
+@register_strategy('roles')
+class RoleQueueStrategy(MatchStrategy):
+    """ロール構成（例: タンク1・ヒーラー1・DPS3 × 2チーム）を満たすマッチを作る
+
+    チケットのロール希望はタグ（role_tag_prefix + ロール名）または string_args[role_arg]
+    （カンマ区切りで複数可）から読む。ロールごとに待ち時間順のキューを作り、
+    毎マッチ供給の少ないロールから埋めるので、複数ロール可のプレイヤーは不足側に回る。
+    どのロールでマッチが作れなくなったかを last_report と警告ログで報告する。
+    """
+
+    @classmethod
+    def compile_config(cls, config):
+        slots = config.get('slots', {'tank': 1, 'healer': 1, 'dps': 3})
+        return {
+            'teams': int(config.get('teams', 2)),
+            'slots': OrderedDict((role, int(count)) for role, count in slots.items()),
+            'role_arg': config.get('role_arg', 'role'),
+            'role_tag_prefix': config.get('role_tag_prefix', 'role.'),
+        }
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.last_report = None
+
+    def _role_queues(self, batch, pooled):
+        """ロール -> 作成時刻順の行番号リスト"""
+        roles = self.config['slots']
+        queues = {role: set() for role in roles}
+
+        for role in roles:
+            for row in bitset_rows(batch.tag_rows(self.config['role_tag_prefix'] + role)):
+                if pooled[row]:
+                    queues[role].add(row)
+
+        column = batch.strings.get(self.config['role_arg'])
+        if column is not None:
+            # 辞書コードごとに一度だけ解釈する
+            parsed = [
+                [role for role in (part.strip() for part in value.split(',')) if role in roles]
+                for value in batch.string_values[self.config['role_arg']]
+            ]
+            for row, code in enumerate(column):
+                if code >= 0 and pooled[row]:
+                    for role in parsed[code]:
+                        queues[role].add(row)
+
+        created = batch.create_time_ns
+        return {role: sorted(rows, key=created.__getitem__) for role, rows in queues.items()}
+
+    def match(self, profile, batch):
+        teams = self.config['teams']
+        slots = self.config['slots']
+        need = {role: count * teams for role, count in slots.items()}
+
+        pooled = bytearray(len(batch))
+        for row in batch.pooled_rows():
+            pooled[row] = 1
+        queues = self._role_queues(batch, pooled)
+        heads = dict.fromkeys(slots, 0)
+        taken = bytearray(len(batch))
+        compatible = batch.opponents.compatible if batch.opponents is not None else None
+
+        def take(role, count, picked, members):
+            """role のキューから count 人を選ぶ。members（このマッチの選出済み行）と対戦できない行は飛ばして残す"""
+            queue_rows = queues[role]
+            head = heads[role]
+            while head < len(queue_rows) and taken[queue_rows[head]]:
+                head += 1
+            heads[role] = head
+            skipped = 0
+            while count and head < len(queue_rows):
+                row = queue_rows[head]
+                head += 1
+                if taken[row]:
+                    continue
+                if compatible is not None and not all(compatible(row, member) for member in members):
+                    skipped += 1
+                    if skipped > REMATCH_LOOKAHEAD:
+                        break
+                    continue
+                taken[row] = 1
+                picked.append(row)
+                members.append(row)
+                count -= 1
+            if compatible is None:
+                heads[role] = head
+            return count == 0
+
+        matches = 0
+        starved = None
+        while starved is None:
+            # 残り供給 / 必要数 が小さいロールから埋める
+            order = sorted(slots, key=lambda role: (len(queues[role]) - heads[role]) / need[role])
+            assignment = {}
+            members = []
+            for role in order:
+                picked = []
+                if not take(role, need[role], picked, members):
+                    starved = role
+                    for row in picked:
+                        taken[row] = 0
+                    for rows in assignment.values():
+                        for row in rows:
+                            taken[row] = 0
+                    break
+                assignment[role] = picked
+            if starved is not None:
+                break
+
+            tickets = []
+            roles = {}
+            for team in range(teams):
+                for role, count in slots.items():
+                    for row in assignment[role][team * count:(team + 1) * count]:
+                        tickets.append(batch.ticket(row))
+                        roles[batch.ids[row]] = {'team': team, 'role': role}
+            match = make_match(profile, tickets)
+            role_struct = struct_pb2.Struct()
+            role_struct.update(roles)
+            match.extensions['roles'].Pack(role_struct)
+            matches += 1
+            yield match
+
+        waiting = {
+            role: sum(1 for row in queues[role] if not taken[row])
+            for role in slots
+        }
+        self.last_report = {'matches': matches, 'starved_role': starved, 'waiting_by_role': waiting}
+        if starved is not None and any(waiting.values()):
+            logger.warning(f"Role '{starved}' is the bottleneck: needs {need[starved]} per match, "
+                           f"{waiting[starved]} waiting; unmatched by role: {waiting}")
+
+
+def parse_strategy_map(spec):
+    mapping = {}
+    for item in spec.split(','):
+        profile_name, _, strategy_name = item.strip().partition('=')
+        if profile_name and strategy_name:
+            mapping[profile_name] = strategy_name.strip()
+    return mapping
+
+
+class StrategyRegistry:
+    """プロファイルから戦略インスタンスを選ぶ。インスタンスは (戦略名, 設定) をキーに LRU で保持する"""
+
+    def __init__(self, default=DEFAULT_MATCH_STRATEGY, by_profile=MATCH_STRATEGY_BY_PROFILE,
+                 max_size=STRATEGY_CACHE_SIZE):
+        self.default = default
+        self.by_profile = parse_strategy_map(by_profile)
+        self.max_size = max_size
+        self._instances = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve_name(self, profile):
+        if 'strategy' in profile.extensions:
+            value = wrappers_pb2.StringValue()
+            if profile.extensions['strategy'].Unpack(value):
+                return value.value
+        if profile.name in self.by_profile:
+            return self.by_profile[profile.name]
+        if profile.name in STRATEGIES:
+            return profile.name
+        return self.default
+
+    def get(self, profile):
+        name = self.resolve_name(profile)
+        if name not in STRATEGIES:
+            raise ValueError(f"Unknown match strategy '{name}' for profile '{profile.name}'")
+
+        config = profile.extensions['strategy_config'] if 'strategy_config' in profile.extensions else None
+        key = (name, config.SerializeToString(deterministic=True) if config is not None else b'')
+        with self._lock:
+            strategy = self._instances.get(key)
+            if strategy is not None:
+                self._instances.move_to_end(key)
+                return strategy
+
+        # 設定の解釈はキャッシュミス時の一度だけ
+        config_dict = {}
+        if config is not None:
+            struct = struct_pb2.Struct()
+            if not config.Unpack(struct):
+                raise ValueError(f"strategy_config of profile '{profile.name}' must be a google.protobuf.Struct")
+            config_dict = json_format.MessageToDict(struct)
+        strategy = STRATEGIES[name](config_dict)
+        logger.info(f"Created match strategy '{name}' with config {config_dict}")
+
+        with self._lock:
+            strategy = self._instances.setdefault(key, strategy)
+            self._instances.move_to_end(key)
+            while len(self._instances) > self.max_size:
+                self._instances.popitem(last=False)
+        return strategy
+
+
+def benchmark_strategy(strategy, profile, batch, repeat=5):
+    """同じ TicketBatch に対して戦略を repeat 回実行し、所要時間とマッチ数を返す"""
+    timings = []
+    matches = tickets = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proposals = list(strategy.match(profile, batch))
+        timings.append(time.perf_counter() - start)
+        matches = len(proposals)
+        tickets = sum(len(match.tickets) for match in proposals)
+    return {
+        'strategy': strategy.name,
+        'tickets': len(batch),
+        'matches': matches,
+        'matched_tickets': tickets,
+        'best_seconds': min(timings),
+        'mean_seconds': sum(timings) / len(timings),
+    }
+
+
+CAPTURE_MAGIC = b'OMCAPTURE1\n'
+
+
+def _write_frame(out, message):
+    data = message.SerializeToString()
+    _write_varint(out, len(data))
+    out.write(data)
+
+
+def _write_varint(out, value):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.write(bytes((byte | 0x80,)))
+        else:
+            out.write(bytes((byte,)))
+            return
+
+
+def _read_varint(stream):
+    shift = value = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift:
+                raise EOFError('truncated varint')
+            return None
+        value |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return value
+        shift += 7
+
+
+def _read_frame(stream, message_class):
+    size = _read_varint(stream)
+    if size is None:
+        raise EOFError('truncated capture record')
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError('truncated capture record')
+    return message_class.FromString(data)
+
+
+class RunCapture:
+    """Run の入力を長さプレフィックス付き protobuf で追記するレコーダー
+
+    1 レコード = Timestamp(取得時刻), RunRequest, varint(プール数),
+    プール数 × (QueryTicketsRequest, QueryTicketsResponse), QueryBackfillsResponse
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._lock, open(path, 'ab') as out:
+            if out.tell() == 0:
+                out.write(CAPTURE_MAGIC)
+
+    def write(self, profile, batch, captured_at_ns=None):
+        pool_tickets = OrderedDict((name, batch.tickets(rows)) for name, rows in batch.pool_rows.items())
+        self.write_pools(profile, pool_tickets, batch.backfills, captured_at_ns)
+
+    def write_pools(self, profile, pool_tickets, backfills, captured_at_ns=None):
+        """プール名 -> チケット一覧 から1レコードを書く（ストリーミングの Run 用）"""
+        captured_at = timestamp_pb2.Timestamp()
+        if captured_at_ns is None:
+            captured_at.GetCurrentTime()
+        else:
+            captured_at.FromNanoseconds(captured_at_ns)
+
+        with self._lock, open(self.path, 'ab') as out:
+            _write_frame(out, captured_at)
+            _write_frame(out, matchfunction_pb2.RunRequest(profile=profile))
+            _write_varint(out, len(pool_tickets))
+            for name, tickets in pool_tickets.items():
+                _write_frame(out, query_pb2.QueryTicketsRequest(pool=messages_pb2.Pool(name=name)))
+                _write_frame(out, query_pb2.QueryTicketsResponse(tickets=tickets))
+            _write_frame(out, query_pb2.QueryBackfillsResponse(backfills=backfills))
+
+
+def read_capture(path):
+    """キャプチャを (取得時刻ns, MatchProfile, TicketBatch) の順に返す"""
+    with open(path, 'rb') as stream:
+        if stream.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a match function capture")
+        while True:
+            size = _read_varint(stream)
+            if size is None:
+                return
+            captured_at = timestamp_pb2.Timestamp.FromString(stream.read(size))
+            request = _read_frame(stream, matchfunction_pb2.RunRequest)
+            pool_tickets = OrderedDict()
+            for _ in range(_read_varint(stream)):
+                pool = _read_frame(stream, query_pb2.QueryTicketsRequest).pool
+                pool_tickets[pool.name] = list(_read_frame(stream, query_pb2.QueryTicketsResponse).tickets)
+            batch = TicketBatch.from_pools(pool_tickets)
+            batch.backfills = list(_read_frame(stream, query_pb2.QueryBackfillsResponse).backfills)
+            yield captured_at.ToNanoseconds(), request.profile, batch
 
 
 class MatchFunctionServicer(matchfunction_pb2_grpc.MatchFunctionServicer):
+    """Query / Frontend への問い合わせは grpc.aio でイベントループ上に載せ、マッチングは呼び出し側のスレッドで行う
+
+    loop を渡さない場合（同期サーバー）は専用スレッドでイベントループを回し、
+    ハンドラースレッドは問い合わせの完了だけを待つ。
+    """
 
-    def __init__(self):
+    def __init__(self, loop=None):
         self.query_service_addr = f'{QUERY_SERVICE_HOST}:{QUERY_SERVICE_PORT}'
+        self.frontend_addr = FRONTEND_SERVICE
+        self.ticket_cache_enabled = TICKET_CACHE_ENABLED
+        self._ticket_caches = OrderedDict()
+        self._ticket_caches_lock = threading.Lock()
+
+        # grpc.aio のチャネルは作成したイベントループでしか使えないため、ループ上で作る
+        if loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='query-loop', daemon=True).start()
+
+            async def connect():
+                self._connect()
+            self._call(connect())
+        else:
+            self._loop = loop
+            self._connect()
+
+        self.strategies = StrategyRegistry()
+        # MATCH_STREAMING を適用しなかった (プロファイル名, 戦略名)（警告は一度だけ）
+        self._streaming_skipped = set()
+        self.recent_opponents = RecentOpponents() if REMATCH_AVOIDANCE else None
+        # プロファイル名 -> {match_id: (チケットID, プレイヤーID, 提案時刻)}
+        self._pending_proposals = {}
+        self._pending_lock = threading.Lock()
+        self.capture = RunCapture(MATCH_CAPTURE_PATH) if MATCH_CAPTURE_PATH else None
+        if self.capture is not None:
+            logger.info(f"Capturing runs to {MATCH_CAPTURE_PATH}")
         logger.info(f"MatchFunction will query tickets from: {self.query_service_addr}")
+        if self.ticket_cache_enabled:
+            logger.info(f"Ticket cache enabled (ttl={TICKET_CACHE_TTL}s, max_size={TICKET_CACHE_MAX_SIZE}), "
+                        f"missing tickets fetched from: {self.frontend_addr}")
+
+    def _connect(self):
+        # チャネルは全Run・全プールで共有する
+        self._query_channel = grpc.aio.insecure_channel(self.query_service_addr)
+        self._query_stub = query_pb2_grpc.QueryServiceStub(self._query_channel)
+        self._frontend_channel = grpc.aio.insecure_channel(self.frontend_addr)
+        self._frontend_stub = frontend_pb2_grpc.FrontendServiceStub(self._frontend_channel)
+
+    def _call(self, coro):
+        """同期サーバーのハンドラースレッドから、問い合わせ用ループ上のコルーチンを実行して結果を待つ"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
 
-    def _query_tickets(self, pool):
+    def _iterate(self, agen):
+        """非同期ジェネレーターを同期ジェネレーターとして読む（_call と同じく同期サーバー用）"""
         try:
-            channel = grpc.insecure_channel(self.query_service_addr)
-            stub = query_pb2_grpc.QueryServiceStub(channel)
+            while True:
+                try:
+                    yield self._call(agen.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._call(agen.aclose())
 
-            request = query_pb2.QueryTicketsRequest(pool=pool)
-            response_iterator = stub.QueryTickets(request, timeout=10)
+    def _get_ticket_cache(self, pool):
+        # フィルタ込みのプール定義をキーにする
+        key = pool.SerializeToString(deterministic=True)
+        with self._ticket_caches_lock:
+            cache = self._ticket_caches.get(key)
+            if cache is None:
+                cache = TicketCache()
+                self._ticket_caches[key] = cache
+                while len(self._ticket_caches) > TICKET_CACHE_MAX_POOLS:
+                    self._ticket_caches.popitem(last=False)
+            else:
+                self._ticket_caches.move_to_end(key)
+            return cache
 
-            tickets = []
-            for response in response_iterator:
-                tickets.extend(response.tickets)
+    async def _query_ticket_ids(self, pool):
+        request = query_pb2.QueryTicketIdsRequest(pool=pool)
+        ticket_ids = []
+        async for response in self._query_stub.QueryTicketIds(request, timeout=QUERY_TIMEOUT):
+            ticket_ids.extend(response.ids)
+        return ticket_ids
+
+    async def _get_tickets(self, ticket_ids):
+        """Frontend の GetTicket で個別取得（同時発行は GET_TICKET_CONCURRENCY 件まで）"""
+        pending = iter(ticket_ids)
+        tickets = []
+
+        async def worker():
+            for ticket_id in pending:
+                ticket = await self._get_ticket(ticket_id)
+                if ticket is not None:
+                    tickets.append(ticket)
+
+        await asyncio.gather(*(worker() for _ in range(min(GET_TICKET_CONCURRENCY, len(ticket_ids)))))
+        return tickets
+
+    async def _get_ticket(self, ticket_id):
+        """GetTicket（取得までの間に削除・アサインされたチケットは None）"""
+        try:
+            return await self._frontend_stub.GetTicket(
+                frontend_pb2.GetTicketRequest(ticket_id=ticket_id), timeout=QUERY_TIMEOUT
+            )
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.NOT_FOUND:
+                raise
+            return None
+
+    async def _query_tickets_cached(self, pool, ticket_ids=None, cache=None):
+        """cache を渡した場合はプールの一部としてそのキャッシュに出し入れする（他のIDは破棄しない）"""
+        if ticket_ids is None:
+            ticket_ids = await self._query_ticket_ids(pool)
+        evict = cache is None
+        if cache is None:
+            cache = self._get_ticket_cache(pool)
+        missing = cache.sync(ticket_ids, evict)
+
+        if missing and len(missing) > len(ticket_ids) * TICKET_CACHE_REFILL_RATIO:
+            cache.put(await self._fetch_tickets(pool))
+            fetched = 'full'
+        elif missing:
+            cache.put(await self._get_tickets(missing))
+            fetched = len(missing)
+        else:
+            fetched = 0
+
+        tickets = cache.get_many(ticket_ids)
+        logger.info(f"Queried {len(tickets)} tickets from pool '{pool.name}' "
+                    f"(cached: {len(ticket_ids) - len(missing)}, fetched: {fetched})")
+        return tickets
+
+    async def _fetch_tickets(self, pool):
+        tickets = []
+        async for page in self._stream_tickets(pool):
+            tickets.extend(page)
+        return tickets
+
+    async def _stream_tickets(self, pool):
+        """QueryTicketsResponse をページ単位で返す"""
+        request = query_pb2.QueryTicketsRequest(pool=pool)
+        call = self._query_stub.QueryTickets(request, timeout=QUERY_TIMEOUT)
+        try:
+            async for response in call:
+                yield response.tickets
+        finally:
+            call.cancel()
+
+    def _match_window(self, profile, strategy, window, histogram):
+        """ウィンドウ内をスキル順に並べて隣同士でマッチを作る（余りはウィンドウに残す）"""
+        batch = TicketBatch(window)
+        scorer = QualityScorer(batch, histogram)
+        compatible = None
+        if self.recent_opponents is not None:
+            compatible = OpponentFilter(batch, self.recent_opponents).compatible
+        groups, leftover = pair_by_skill(batch.double('skill'), range(len(batch)), strategy.config['size'], compatible)
+        matches = [make_match(profile, batch.tickets(group)) for group in groups]
+        scorer.attach_all(matches)
+        for match in matches:
+            if self.recent_opponents is not None:
+                self._track_proposal(profile, match)
+            yield match
+        window[:] = batch.tickets(leftover)
+
+    async def _stream_pools(self, profile):
+        """全プールを並行にストリーミングし、(pool, page) を到着順に返す
+
+        LOCAL_POOL_FILTERING で複数プールの場合は共通フィルタの1本だけを流し、
+        ページをプールごとにローカルで振り分ける。
+        """
+        if LOCAL_POOL_FILTERING and len(profile.pools) > 1:
+            filters = [(pool, PoolFilter(pool)) for pool in profile.pools]
+            async for _, page in self._stream_queries([superset_pool(profile.pools)]):
+                for pool, pool_filter in filters:
+                    yield pool, [ticket for ticket in page if pool_filter.matches(ticket)]
+            return
+
+        async for item in self._stream_queries(profile.pools):
+            yield item
+
+    async def _stream_queries(self, pools):
+        pages = asyncio.Queue(maxsize=POOL_QUERY_WORKERS * 2)
+        done = object()
+
+        async def pump(pool):
+            count = 0
+            try:
+                async with contextlib.aclosing(self._stream_tickets(pool)) as stream:
+                    async for page in stream:
+                        if MAX_TICKETS_PER_POOL > 0:
+                            page = page[:MAX_TICKETS_PER_POOL - count]
+                        count += len(page)
+                        await pages.put((pool, page))
+                        if count == MAX_TICKETS_PER_POOL:
+                            break
+            except grpc.RpcError as e:
+                logger.error(f"gRPC error streaming tickets from pool '{pool.name}': {e.code()} - {e.details()}")
+            logger.info(f"Streamed {count} tickets from pool '{pool.name}'")
+            await pages.put(done)
+
+        tasks = [asyncio.create_task(pump(pool)) for pool in pools]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await pages.get()
+                if item is done:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _stream_windows(self, profile, window):
+        """ページを window に溜め、MATCH_WINDOW_SIZE に達するたびに yield する
+
+        呼び出し側は yield のたびに window をマッチングして余りだけに縮め、
+        終了後に残った window を最後にマッチングする。
+        """
+        logger.info(f"Match profile: {profile.name}")
+        logger.info(f"Number of pools: {len(profile.pools)}")
+
+        # 複数プールに同じチケットが含まれる場合の重複排除（再戦回避では提案の確認にも使う）
+        seen = set() if len(profile.pools) > 1 or self.recent_opponents is not None else None
+        captured = OrderedDict() if self.capture is not None else None
+        # ウィンドウごとの提案は走行中に _pending_proposals に入るので、確認は開始前の提案に限る
+        earlier = self._pending_match_ids(profile) if self.recent_opponents is not None else None
+
+        async for pool, page in self._stream_pools(profile):
+            if captured is not None:
+                captured.setdefault(pool.name, []).extend(page)
+            for ticket in page:
+                if seen is not None:
+                    if ticket.id in seen:
+                        continue
+                    seen.add(ticket.id)
+                window.append(ticket)
+                if len(window) >= MATCH_WINDOW_SIZE:
+                    yield window
+
+        if self.recent_opponents is not None:
+            await self._confirm_assignments(profile, seen, earlier)
+
+        if captured is not None:
+            backfills = await self._query_backfills(profile)
+            try:
+                await asyncio.to_thread(self.capture.write_pools, profile, captured, backfills)
+            except OSError as e:
+                logger.error(f"Failed to capture run: {e}")
+
+    def _streaming_strategy(self, profile):
+        """MATCH_STREAMING でウィンドウ単位に流せる戦略（skill-pairs）なら返す。それ以外は None"""
+        if not MATCH_STREAMING:
+            return None
+        strategy = self.strategies.get(profile)
+        if isinstance(strategy, SkillPairsStrategy):
+            return strategy
+        key = (profile.name, strategy.name)
+        if key not in self._streaming_skipped:
+            self._streaming_skipped.add(key)
+            logger.warning(f"Strategy '{strategy.name}' of profile '{profile.name}' needs the whole pool; "
+                           f"ignoring MATCH_STREAMING for this profile")
+        return None
+
+    def _run_streaming(self, profile, strategy, histogram):
+        window = []
+        for _ in self._iterate(self._stream_windows(profile, window)):
+            yield from self._match_window(profile, strategy, window, histogram)
+        yield from self._match_window(profile, strategy, window, histogram)
 
-            channel.close()
+    async def _query_oldest(self, pool, limit):
+        """古い時間帯から順にサブクエリし、上限に達したら打ち切る
+
+        各時間帯は QueryTicketIds で件数を確かめてから取得し、残り枠を超える時間帯は
+        bisect_slice で分けて古い側から進める。分けられない時間帯は残り枠に達した時点で
+        QueryTickets を打ち切る。取得したチケットは元のプールのキャッシュに入れる。
+        """
+        now_ns = time.time_ns()
+        cache = self._get_ticket_cache(pool) if self.ticket_cache_enabled else None
+        # 末尾が最も古い時間帯のスタック
+        pending = time_slices(pool, now_ns)[::-1]
+        tickets = []
+        queries = 0
+        try:
+            while pending and len(tickets) < limit:
+                sub = pending.pop()
+                remaining = limit - len(tickets)
+                ticket_ids = await self._query_ticket_ids(sub)
+                queries += 1
+                if not ticket_ids:
+                    continue
+                if len(ticket_ids) <= remaining:
+                    if cache is not None:
+                        part = await self._query_tickets_cached(sub, ticket_ids, cache)
+                    else:
+                        part = await self._query_head(sub, remaining)
+                    tickets.extend(part[:remaining])
+                    continue
+                halves = bisect_slice(sub, now_ns)
+                if halves is not None:
+                    pending.extend(reversed(halves))
+                else:
+                    tickets.extend(await self._query_head(sub, remaining))
+        except grpc.RpcError as e:
+            # 新しい時間帯に進むと最も古いチケットが取り残されるので、ここで止める
+            logger.error(f"gRPC error querying oldest tickets from pool '{pool.name}', "
+                         f"stopping at {len(tickets)} tickets: {e.code()} - {e.details()}")
+        logger.info(f"Pool '{pool.name}' took {len(tickets)} oldest tickets in {queries} time slice queries")
+        return tickets
+
+    async def _query_head(self, pool, limit):
+        """QueryTickets を limit 件に達した時点で打ち切る"""
+        tickets = []
+        async with contextlib.aclosing(self._stream_tickets(pool)) as stream:
+            async for page in stream:
+                tickets.extend(page[:limit - len(tickets)])
+                if len(tickets) >= limit:
+                    break
+        return tickets
+
+    async def _query_sample(self, pool, limit):
+        """QueryTickets を流しながらリザーバサンプリングする（メモリは limit 件まで）"""
+        sample = []
+        seen = 0
+        rng = random.Random()
+        try:
+            async with contextlib.aclosing(self._stream_tickets(pool)) as stream:
+                async for page in stream:
+                    for ticket in page:
+                        seen += 1
+                        if len(sample) < limit:
+                            sample.append(ticket)
+                        else:
+                            j = rng.randrange(seen)
+                            if j < limit:
+                                sample[j] = ticket
+        except grpc.RpcError as e:
+            logger.error(f"gRPC error sampling tickets from pool '{pool.name}': {e.code()} - {e.details()}")
+        logger.info(f"Sampled {len(sample)} of {seen} tickets from pool '{pool.name}'")
+        return sample
+
+    async def _query_tickets(self, pool):
+        if MAX_TICKETS_PER_POOL <= 0:
+            return await self._query_tickets_unbounded(pool)
+
+        try:
+            ticket_ids = await self._query_ticket_ids(pool)
+        except grpc.RpcError as e:
+            logger.warning(f"QueryTicketIds failed, sampling pool '{pool.name}' instead: {e.code()} - {e.details()}")
+            return await self._query_sample(pool, MAX_TICKETS_PER_POOL)
+
+        if len(ticket_ids) <= MAX_TICKETS_PER_POOL:
+            return await self._query_tickets_unbounded(pool, ticket_ids)
+
+        logger.warning(f"Pool '{pool.name}' has {len(ticket_ids)} tickets, over the limit of "
+                       f"{MAX_TICKETS_PER_POOL}; using '{QUERY_OVERFLOW_POLICY}' policy")
+        if QUERY_OVERFLOW_POLICY == 'sample':
+            return await self._query_sample(pool, MAX_TICKETS_PER_POOL)
+        return await self._query_oldest(pool, MAX_TICKETS_PER_POOL)
+
+    async def _query_tickets_unbounded(self, pool, ticket_ids=None):
+        if self.ticket_cache_enabled:
+            try:
+                return await self._query_tickets_cached(pool, ticket_ids)
+            except grpc.RpcError as e:
+                logger.warning(f"Cached ticket query failed, falling back to QueryTickets: "
+                               f"{e.code()} - {e.details()}")
+
+        try:
+            tickets = await self._fetch_tickets(pool)
             logger.info(f"Queried {len(tickets)} tickets from pool '{pool.name}'")
             return tickets
 
@@ -54,43 +1672,200 @@ class MatchFunctionServicer(matchfunction_pb2_grpc.MatchFunctionServicer):
             logger.error(f"Error querying tickets: {e}", exc_info=True)
             return []
 
-    def Run(self, request, context):
-        try:
-            logger.info("MatchFunction.Run called")
+    async def _query_pools(self, profile):
+        """全プールを並行に問い合わせ、プール名 -> チケット一覧 を返す（プール順を保持）"""
+        limit = asyncio.Semaphore(POOL_QUERY_WORKERS)
+
+        async def query(pool):
+            async with limit:
+                return await self._query_tickets(pool)
 
-            profile = request.profile
-            logger.info(f"Match profile: {profile.name}")
-            logger.info(f"Number of pools: {len(profile.pools)}")
+        results = await asyncio.gather(*(query(pool) for pool in profile.pools))
+        pool_tickets = OrderedDict()
+        for pool, tickets in zip(profile.pools, results):
+            pool_tickets.setdefault(pool.name, []).extend(tickets)
+        return pool_tickets
 
-            # 全プールからチケットを収集
-            all_tickets = []
+    async def _query_backfills(self, profile):
+        """全プールの Backfill を並行に問い合わせ、ID で重複排除して返す"""
+
+        async def query(pool):
+            request = query_pb2.QueryBackfillsRequest(pool=pool)
+            backfills = []
+            try:
+                async for response in self._query_stub.QueryBackfills(request, timeout=QUERY_TIMEOUT):
+                    backfills.extend(response.backfills)
+            except grpc.RpcError as e:
+                logger.error(f"gRPC error querying backfills: {e.code()} - {e.details()}")
+            return backfills
+
+        backfills = OrderedDict()
+        for result in await asyncio.gather(*(query(pool) for pool in profile.pools)):
+            for backfill in result:
+                backfills.setdefault(backfill.id, backfill)
+        logger.info(f"Queried {len(backfills)} backfills")
+        return list(backfills.values())
+
+    def _pending_match_ids(self, profile):
+        with self._pending_lock:
+            return set(self._pending_proposals.get(profile.name, ()))
+
+    async def _confirm_assignments(self, profile, present_ids, match_ids=None):
+        """前回までの提案のうち、実際に同じ接続先へアサインされたものだけを対戦記録に入れる
+
+        match_ids を渡すとその提案だけを確かめる（ストリーミングで今回の Run の提案を除くため）。
+
+        チケットがプールに戻った提案は不採用として捨てる。プールに無いチケットは GetTicket で確かめ、
+        全員が同じ接続先にアサインされていれば記録し、削除済み・別々の接続先なら捨てる。
+        まだアサインされていない提案は REMATCH_CONFIRM_SECONDS まで次の Run に持ち越す。
+        """
+        released = 0
+        waiting = []
+        with self._pending_lock:
+            pending = self._pending_proposals.setdefault(profile.name, OrderedDict())
+            for match_id, (ticket_ids, players, proposed_at) in list(pending.items()):
+                if match_ids is not None and match_id not in match_ids:
+                    continue
+                if any(ticket_id in present_ids for ticket_id in ticket_ids):
+                    # 採用されずプールに戻った
+                    del pending[match_id]
+                    released += 1
+                else:
+                    waiting.append((match_id, ticket_ids, players, proposed_at))
+
+        confirmed = dropped = 0
+        if waiting:
+            try:
+                found = await self._get_tickets([ticket_id for _, ticket_ids, _, _ in waiting for ticket_id in ticket_ids])
+            except grpc.RpcError as e:
+                logger.warning(f"Could not check assignments of {len(waiting)} proposals: {e.code()} - {e.details()}")
+                found = None
+
+            if found is not None:
+                connections = {ticket.id: ticket.assignment.connection for ticket in found}
+                now = time.monotonic()
+                with self._pending_lock:
+                    for match_id, ticket_ids, players, proposed_at in waiting:
+                        assigned_to = {connections.get(ticket_id) for ticket_id in ticket_ids}
+                        if len(assigned_to) == 1 and None not in assigned_to and '' not in assigned_to:
+                            if pending.pop(match_id, None) is not None:
+                                self.recent_opponents.record(players, now)
+                                confirmed += 1
+                        elif None in assigned_to or len(assigned_to - {''}) > 1 \
+                                or now - proposed_at >= REMATCH_CONFIRM_SECONDS:
+                            # 削除された・別のマッチでアサインされた・アサインされないまま期限切れ
+                            if pending.pop(match_id, None) is not None:
+                                dropped += 1
+
+        if confirmed or released or dropped:
+            logger.info(f"Recorded {confirmed} assigned matches, dropped {released} released and "
+                        f"{dropped} unassigned proposals ({len(self.recent_opponents)} players tracked)")
+
+    def _track_proposal(self, profile, match):
+        players = [
+            ticket.search_fields.string_args[PLAYER_ID_ARG]
+            for ticket in match.tickets
+            if PLAYER_ID_ARG in ticket.search_fields.string_args
+        ]
+        if len(players) < 2:
+            return
+        with self._pending_lock:
+            pending = self._pending_proposals.setdefault(profile.name, OrderedDict())
+            pending[match.match_id] = ([ticket.id for ticket in match.tickets], players, time.monotonic())
+            while len(pending) > REMATCH_MAX_PLAYERS:
+                pending.popitem(last=False)
+
+    async def _collect(self, profile):
+        """Run の問い合わせ部分。(戦略, プール名 -> チケット一覧, 共通フィルタの結果, Backfill 一覧) を返す
+
+        LOCAL_POOL_FILTERING で複数プールの場合は共通フィルタで1回だけ問い合わせ、
+        プール名 -> チケット一覧 の代わりに共通フィルタの結果を返す（振り分けは _build_batch で行う）。
+        """
+        logger.info(f"Match profile: {profile.name}")
+        logger.info(f"Number of pools: {len(profile.pools)}")
+
+        strategy = self.strategies.get(profile)
+        pool_tickets = superset_tickets = None
+        if LOCAL_POOL_FILTERING and len(profile.pools) > 1:
+            superset_tickets = await self._query_tickets(superset_pool(profile.pools))
+        else:
+            pool_tickets = await self._query_pools(profile)
+
+        if self.recent_opponents is not None:
+            present = superset_tickets if superset_tickets is not None else \
+                [ticket for tickets in pool_tickets.values() for ticket in tickets]
+            await self._confirm_assignments(profile, {ticket.id for ticket in present})
+
+        backfills = []
+        if strategy.uses_backfills or self.capture is not None:
+            backfills = await self._query_backfills(profile)
+        return strategy, pool_tickets, superset_tickets, backfills
+
+    def _build_batch(self, profile, pool_tickets, superset_tickets, backfills):
+        """_collect の結果から TicketBatch を作る（CPU 処理のため executor / ハンドラースレッドで呼ぶ）"""
+        if superset_tickets is not None:
+            batch = TicketBatch(superset_tickets)
             for pool in profile.pools:
-                tickets = self._query_tickets(pool)
-                all_tickets.extend(tickets)
+                rows = bitset_rows(PoolFilter(pool).evaluate(batch))
+                batch.pool_rows.setdefault(pool.name, array('i')).extend(rows)
+                logger.info(f"Pool '{pool.name}' matched {len(rows)} of {len(batch)} superset tickets")
+        else:
+            batch = TicketBatch.from_pools(pool_tickets)
+        batch.backfills = backfills
+        logger.info(f"Total tickets to process: {len(batch)}")
+        return batch
 
-            logger.info(f"Total tickets to process: {len(all_tickets)}")
+    def _match(self, profile, strategy, batch):
+        """TicketBatch からマッチ提案を順に返す（同期 / aio サーバー共通）"""
+        if self.capture is not None:
+            try:
+                self.capture.write(profile, batch)
+            except OSError as e:
+                logger.error(f"Failed to capture run: {e}")
+        if self.recent_opponents is not None:
+            batch.opponents = OpponentFilter(batch, self.recent_opponents)
 
-            # 2人マッチを作成
-            if len(all_tickets) >= 2:
-                ticket1 = all_tickets[0]
-                ticket2 = all_tickets[1]
+        proposals = 0
+        scorer = QualityScorer(batch)
+        matches = strategy.match(profile, batch)
+        # スコアは MATCH_CHUNK_SIZE 件ずつ配列演算で付与する
+        for chunk in iter(lambda: list(itertools.islice(matches, max(1, MATCH_CHUNK_SIZE))), []):
+            proposals += len(chunk)
+            scorer.attach_all(chunk)
+            for match in chunk:
+                if self.recent_opponents is not None:
+                    self._track_proposal(profile, match)
+                yield match
+        logger.info(f"Strategy '{strategy.name}' created {proposals} match proposals")
+        if proposals:
+            logger.info(f"Match quality for '{profile.name}': {format_quality_histogram(scorer.histogram)}")
 
-                match_id = f"match-{int(time.time())}"
+    def _propose(self, profile):
+        """プロファイルに対するマッチ提案を順に返す（同期サーバー用）"""
+        streaming = self._streaming_strategy(profile)
+        if streaming is not None:
+            proposals = 0
+            histogram = [0] * QUALITY_BUCKETS
+            for match in self._run_streaming(profile, streaming, histogram):
+                proposals += 1
+                yield match
+            log_streamed(profile, proposals, histogram)
+            return
 
-                match = messages_pb2.Match(
-                    match_id=match_id,
-                    match_profile=profile.name,
-                    match_function="matchfunction",
-                    tickets=[ticket1, ticket2]
-                )
+        strategy, pool_tickets, superset_tickets, backfills = self._call(self._collect(profile))
+        batch = self._build_batch(profile, pool_tickets, superset_tickets, backfills)
+        yield from self._match(profile, strategy, batch)
 
-                logger.info(f"Created match {match_id} with tickets: {ticket1.id}, {ticket2.id}")
+    def Run(self, request, context):
+        try:
+            logger.info("MatchFunction.Run called")
 
-                response = matchfunction_pb2.RunResponse(proposal=match)
-                yield response
+            proposals = 0
+            for match in self._propose(request.profile):
+                proposals += 1
+                yield matchfunction_pb2.RunResponse(proposal=match)
 
-            else:
-                logger.info("Not enough tickets for a 2-player match")
+            if proposals == 0:
                 yield matchfunction_pb2.RunResponse()
 
         except Exception as e:
@@ -100,8 +1875,127 @@ class MatchFunctionServicer(matchfunction_pb2_grpc.MatchFunctionServicer):
             yield matchfunction_pb2.RunResponse()
 
 
-def serve_grpc(port=50502):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+def log_streamed(profile, proposals, histogram):
+    logger.info(f"Streamed {proposals} match proposals")
+    logger.info(f"Match quality for '{profile.name}': {format_quality_histogram(histogram)}")
+
+
+class AsyncMatchFunctionServicer(matchfunction_pb2_grpc.MatchFunctionServicer):
+    """grpc.aio 版。問い合わせはイベントループ上で待ち、TicketBatch の構築とマッチングだけを executor で行う"""
+
+    def __init__(self, servicer, executor, max_concurrent_runs):
+        self._servicer = servicer
+        self._executor = executor
+        self._limit = asyncio.Semaphore(max_concurrent_runs)
+
+    async def _propose(self, profile):
+        servicer = self._servicer
+        loop = asyncio.get_running_loop()
+
+        streaming = servicer._streaming_strategy(profile)
+        if streaming is not None:
+            window = []
+            proposals = 0
+            histogram = [0] * QUALITY_BUCKETS
+
+            def match_window():
+                return list(servicer._match_window(profile, streaming, window, histogram))
+
+            async with contextlib.aclosing(servicer._stream_windows(profile, window)) as windows:
+                async for _ in windows:
+                    for match in await loop.run_in_executor(self._executor, match_window):
+                        proposals += 1
+                        yield match
+            for match in await loop.run_in_executor(self._executor, match_window):
+                proposals += 1
+                yield match
+            log_streamed(profile, proposals, histogram)
+            return
+
+        strategy, pool_tickets, superset_tickets, backfills = await servicer._collect(profile)
+        batch = await loop.run_in_executor(
+            self._executor, servicer._build_batch, profile, pool_tickets, superset_tickets, backfills
+        )
+        matches = servicer._match(profile, strategy, batch)
+
+        def next_chunk():
+            return list(itertools.islice(matches, max(1, MATCH_CHUNK_SIZE)))
+
+        try:
+            while True:
+                # 提案ごとにスレッドを往復すると大きなプールで同期サーバーより遅くなるので、まとめて受け取る
+                chunk = await loop.run_in_executor(self._executor, next_chunk)
+                if not chunk:
+                    break
+                for match in chunk:
+                    yield match
+        finally:
+            try:
+                await loop.run_in_executor(self._executor, matches.close)
+            except ValueError:
+                # キャンセル時に executor 側でまだ実行中の場合は GC に任せる
+                pass
+
+    async def Run(self, request, context):
+        async with self._limit:
+            try:
+                logger.info("MatchFunction.Run called")
+
+                count = 0
+                async with contextlib.aclosing(self._propose(request.profile)) as proposals:
+                    async for match in proposals:
+                        count += 1
+                        yield matchfunction_pb2.RunResponse(proposal=match)
+
+                if count == 0:
+                    yield matchfunction_pb2.RunResponse()
+
+            except Exception as e:
+                logger.error(f"Error in MatchFunction.Run: {e}", exc_info=True)
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details(f'Internal error: {str(e)}')
+                yield matchfunction_pb2.RunResponse()
+
+
+async def _serve_worker_async(port, threads, max_concurrent_runs):
+    executor = futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='match')
+    server = grpc.aio.server(options=[('grpc.so_reuseport', 1)])
+
+    matchfunction_pb2_grpc.add_MatchFunctionServicer_to_server(
+        AsyncMatchFunctionServicer(
+            MatchFunctionServicer(asyncio.get_running_loop()), executor, max_concurrent_runs
+        ),
+        server
+    )
+
+    server.add_insecure_port(f'[::]:{port}')
+
+    logger.info(f"MatchFunction grpc.aio server starting on port {port} (pid {os.getpid()}, "
+                f"executor threads {threads}, max concurrent runs {max_concurrent_runs})")
+    await server.start()
+
+    logger.info("MatchFunction server ready")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down...")
+    await server.stop(grace=5)
+    executor.shutdown(wait=False)
+
+
+def _serve_worker(port, threads, use_aio=False, max_concurrent_runs=100):
+    if use_aio:
+        asyncio.run(_serve_worker_async(port, threads, max_concurrent_runs))
+        return
+
+    server = grpc.server(
+        futures.ThreadPoolExecutor(max_workers=threads),
+        options=[('grpc.so_reuseport', 1)]
+    )
 
     matchfunction_pb2_grpc.add_MatchFunctionServicer_to_server(
         MatchFunctionServicer(), server
@@ -109,16 +2003,50 @@ def serve_grpc(port=50502):
 
     server.add_insecure_port(f'[::]:{port}')
 
-    logger.info(f"MatchFunction gRPC server starting on port {port}")
+    logger.info(f"MatchFunction gRPC server starting on port {port} (pid {os.getpid()}, threads {threads})")
     server.start()
 
     logger.info("MatchFunction server ready")
 
-    try:
-        server.wait_for_termination()
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
-        server.stop(grace=5)
+    # SIGTERM / SIGINT で新規RPCの受付を止め、処理中のRPCを待ってから終了する
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    stop.wait()
+
+    logger.info("Shutting down...")
+    server.stop(grace=5).wait()
+
+
+def serve_grpc(port=50502, workers=1, threads=10, use_aio=False, max_concurrent_runs=100):
+    if workers <= 1:
+        _serve_worker(port, threads, use_aio, max_concurrent_runs)
+        return
+
+    # プリフォーク: 同じポートに SO_REUSEPORT で bind したワーカープロセスを起動する
+    # （gRPC のチャネル・サーバーは fork 前に作らない）
+    processes = []
+    for _ in range(workers):
+        process = multiprocessing.Process(
+            target=_serve_worker, args=(port, threads, use_aio, max_concurrent_runs)
+        )
+        process.start()
+        processes.append(process)
+    logger.info(f"Started {workers} MatchFunction workers on port {port}: {[p.pid for p in processes]}")
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            logger.warning(f"Worker {process.pid} exited with code {process.exitcode}")
+    logger.info("All workers stopped")
 
 
 if __name__ == '__main__':
@@ -126,10 +2054,20 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='OpenMatch MatchFunction (gRPC)')
     parser.add_argument('--port', type=int, default=50502, help='Port to listen on')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('GRPC_WORKERS', '1')),
+                        help='Number of server processes sharing the port (SO_REUSEPORT)')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('GRPC_THREADS', '10')),
+                        help='Handler threads per server process (matching executor threads with --aio)')
+    parser.add_argument('--aio', action='store_true', default=os.getenv('GRPC_AIO', 'false').lower() == 'true',
+                        help='Serve with grpc.aio (asyncio) instead of a thread-per-stream server')
+    parser.add_argument('--max-concurrent-runs', type=int, default=int(os.getenv('MAX_CONCURRENT_RUNS', '100')),
+                        help='Run streams processed at once with --aio (the rest wait their turn)')
 
     args = parser.parse_args()
 
     logger.info("Starting MatchFunction gRPC server...")
     logger.info(f"Port: {args.port}")
+    logger.info(f"Workers: {args.workers}, threads per worker: {args.threads}")
+    logger.info(f"Server: {'grpc.aio' if args.aio else 'grpc (sync)'}")
 
-    serve_grpc(args.port)
+    serve_grpc(args.port, args.workers, args.threads, args.aio, args.max_concurrent_runs)